@@ -68,13 +68,13 @@ def make_inferences():
         # Iterate over dataset DSTC9.
         for i in tqdm(range(0, len(df)), desc="Dialogue ratings progress"):
 
-            # Read context and response to DSTC9 dataset.
+            # Read context and response to DSTC9 dataset (the context held by the dataframe is not modified,
+            # otherwise every run would append the response again).
             context = df['contexts'][i]
             response = df['responses'][i]
-            context.append(response)
 
             # Create formatted dialogue to send to GPT4.
-            dialogue = create_prompt(context)
+            dialogue = create_prompt(context + [response])
 
             # Request to API.
             api_response = client.chat.completions.create(
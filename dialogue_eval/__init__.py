@@ -0,0 +1 @@
+# Shared evaluation code for the LLM dialogue evaluators.
@@ -0,0 +1,5 @@
+from dialogue_eval.cli import main
+
+
+if __name__ == '__main__':
+    main()
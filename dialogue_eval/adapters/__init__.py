@@ -0,0 +1 @@
+# Parsers of the dataset files of _datasets into Example records, one module per dataset format.
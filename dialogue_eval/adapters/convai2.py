@@ -0,0 +1,19 @@
+from dialogue_eval.records import Example
+
+
+FILE = "convai2_data.json"
+
+
+# Dialogue-level examples of ConvAI2: the rated dialogues of more than one turn.
+# A turn text may hold several lines, each of them is a turn of the prompt.
+def dialogues(convai2_data: list):
+    for dialog_id, example in enumerate(convai2_data):
+        dialog = example['dialog']
+        if len(dialog) > 1 and example['eval_score'] is not None:
+            turns = tuple(line for turn in dialog for line in turn['text'].split("\n"))
+            speakers = tuple(turn['sender'] for turn in dialog for _ in turn['text'].split("\n"))
+            yield Example(dialog_id, turns, None, int(example['eval_score']),
+                          {"dialog_id": example['dialog_id'], "profile_match": example['profile_match']}, speakers)
+
+
+LEVELS = {"dialogue": dialogues}
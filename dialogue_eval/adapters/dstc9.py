@@ -0,0 +1,15 @@
+from dialogue_eval.records import Example
+
+
+FILE = "dstc9_data.json"
+
+
+# Dialogue-level examples of DSTC9: the context, and the response that follows it.
+def dialogues(dstc9_data: dict):
+    columns = zip(dstc9_data['contexts'], dstc9_data['responses'], dstc9_data['scores'], dstc9_data['models'],
+                  dstc9_data['references'])
+    for i, (context, response, score, model, reference) in enumerate(columns):
+        yield Example(i, context, response, score, {"model": model, "reference": reference})
+
+
+LEVELS = {"dialogue": dialogues}
@@ -0,0 +1,52 @@
+from dialogue_eval.records import Example, mean_rating
+
+
+FILE = "fed_data.json"
+
+
+# Text of a FED turn, without the speaker prefix.
+def _turn(text: str):
+    return text.replace("User: ", "").replace("System: ", "").strip()
+
+
+# Turns of a FED conversation, without the speaker prefixes.
+def _turns(text: str):
+    return tuple(_turn(s) for s in text.split("\n"))
+
+
+# Speaker of a FED turn, from its prefix.
+def _speaker(text: str):
+    return "System" if text.startswith("System: ") else "User"
+
+
+# Speakers of the turns of a FED conversation.
+def _speakers(text: str):
+    return tuple(_speaker(s) for s in text.split("\n"))
+
+
+# Turn-level examples of FED: the data points with a response.
+def turns(fed_data: list):
+    for dialog_id, example in enumerate(fed_data):
+        response = example.get("response")
+        if response is None:
+            # this is a conversation data point, not a turn data point
+            continue
+        yield Example(dialog_id, _turns(example["context"]), _turn(response),
+                      mean_rating(example["annotations"]["Overall"]), {"system": example["system"]},
+                      _speakers(example["context"]) + (_speaker(response),))
+
+
+# Dialogue-level examples of FED: the data points without a response.
+def dialogues(fed_data: list):
+    for dialog_id, example in enumerate(fed_data):
+        response = example.get("response")
+        if response is not None:
+            # this is a turn data point, not a conversation data point
+            continue
+        # As in the original scripts, the missing response (None) closes the dialogue.
+        yield Example(dialog_id, _turns(example["context"]) + (None,), None,
+                      mean_rating(example["annotations"]["Overall"]), {"system": example["system"]},
+                      _speakers(example["context"]) + (None,))
+
+
+LEVELS = {"turn": turns, "dialogue": dialogues}
@@ -0,0 +1,18 @@
+from dialogue_eval.records import Example, mean_rating
+
+
+# PC USR (PersonaChat) and TC USR (Topical-Chat) share this format.
+FILES = {"pc_usr": "pc_usr_data.json", "tc_usr": "tc_usr_data.json"}
+
+
+# Turn-level examples of USR, one per response of every context.
+def turns(usr_data: list):
+    for dialog_id, example in enumerate(usr_data):
+        context = tuple(example["context"].split("\n"))
+        for response_data in example["responses"]:
+            yield Example(dialog_id, context, response_data["response"].split("\n")[0],
+                          mean_rating(response_data["Overall"]),
+                          {"model": response_data["model"], "fact": example["fact"]})
+
+
+LEVELS = {"turn": turns}
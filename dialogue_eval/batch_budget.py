@@ -0,0 +1,55 @@
+import json
+import os
+
+import torch
+
+from dialogue_eval.journal import write_json_atomic
+from dialogue_eval.models import ROOT
+
+
+# Default location of the learned batch budgets, in the repository root.
+DEFAULT_PATH = os.path.join(ROOT, ".cache", "batch_budgets.json")
+
+
+# Messages of the RuntimeErrors raised by failed allocations.
+_OUT_OF_MEMORY_MESSAGES = ("out of memory", "can't allocate memory", "not enough memory")
+
+
+# Whether an error is an allocation failure: CUDA out of memory, or the CPU allocator failing (RuntimeError).
+def is_out_of_memory(error: BaseException):
+    if isinstance(error, (torch.cuda.OutOfMemoryError, MemoryError)):
+        return True
+    message = str(error).lower()
+    return isinstance(error, RuntimeError) and any(text in message for text in _OUT_OF_MEMORY_MESSAGES)
+
+
+# Release the memory cached by the allocator after an allocation failure.
+def release_memory():
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+# Padded tokens of a batch budget learned per model (keyed by the score cache namespace: checkpoint, revision,
+# dtype, scoring mode and labels), in a JSON file. A budget only goes down, when a batch fails to allocate, and is
+# kept for the next runs of the model.
+class BatchBudgets:
+
+    def __init__(self, file_path: str = DEFAULT_PATH):
+        self.file_path = file_path
+
+    def read(self):
+        if not os.path.exists(self.file_path):
+            return {}
+        with open(self.file_path, 'r') as budgets_file:
+            return json.load(budgets_file)
+
+    # Learned budget of a model, or None.
+    def get(self, key: str):
+        return self.read().get(key)
+
+    # Lower the budget of a model, re-reading the file so that the budgets of other processes are kept.
+    def lower(self, key: str, budget: int):
+        budgets = self.read()
+        if key not in budgets or budget < budgets[key]:
+            budgets[key] = budget
+            write_json_atomic(self.file_path, budgets)
@@ -0,0 +1,358 @@
+import os
+
+from dialogue_eval.datasets import DATASETS, build_examples, load_dataset
+from dialogue_eval.models import ROOT
+from dialogue_eval.prompts import RENDERERS
+from dialogue_eval.templates import tokenize_prompts
+
+
+# Number of tokens of texts: with the tokenizer if given, otherwise their whitespace-separated words.
+def _count_tokens(texts: list, tokenizer=None):
+    if tokenizer is None:
+        return [len(text.split()) for text in texts]
+    return [len(ids) for ids in tokenize_prompts(tokenizer, texts)]
+
+
+# Token count of every example prompt over repeated passes on the same loaded dataset, as the evaluations of
+# several runs do. Prompt construction must not modify the dataset, so every pass has the same counts.
+def prompt_tokens_benchmark(dataset: str, level: str, repeats: int = 5, tokenizer=None, root: str = None):
+    from dialogue_eval.evaluate import render_prompt
+
+    data = load_dataset(dataset, os.path.join(root or ROOT, "_datasets"))
+    passes = []
+    for _ in range(repeats):
+        passes.append(_count_tokens([render_prompt(example, level) for example in build_examples(dataset, level, data)],
+                                    tokenizer))
+
+    drift = max(abs(count - first) for counts in passes for count, first in zip(counts, passes[0]))
+    return {
+        "dataset": dataset,
+        "level": level,
+        "examples": len(passes[0]),
+        "tokens_per_pass": [sum(counts) for counts in passes],
+        "max_drift": drift,
+    }
+
+
+# Run the prompt tokens benchmark on every dataset and level, and print one line per pass.
+def run_prompt_tokens_benchmark(datasets: list, repeats: int = 5, tokenizer=None, root: str = None):
+    stable = True
+    for dataset in datasets:
+        for level in DATASETS[dataset]["levels"]:
+            result = prompt_tokens_benchmark(dataset, level, repeats, tokenizer, root)
+            for repeat, tokens in enumerate(result["tokens_per_pass"]):
+                print(f"{dataset} {level}-level pass {repeat + 1}: {tokens} tokens over {result['examples']} "
+                      f"examples ({tokens / max(result['examples'], 1):.1f} per example)")
+            print(f"{dataset} {level}-level max drift per example: {result['max_drift']} tokens")
+            stable = stable and result["max_drift"] == 0
+    return stable
+
+
+# Tokens of the prompts of a dataset at a level with every renderer.
+def renderer_tokens(dataset: str, level: str, tokenizer=None, root: str = None):
+    from dialogue_eval.evaluate import build_prompts
+
+    return {renderer: sum(_count_tokens([prompt for _, prompt in build_prompts(dataset, level, root or ROOT, renderer)],
+                                        tokenizer))
+            for renderer in RENDERERS}
+
+
+# Report the tokens saved by the "lines" renderer per dataset and tokenizer and, for a model whose ratings exist
+# with both renderers, the correlations of each with the human ratings.
+def run_renderer_report(datasets: list, tokenizers: dict, model_name: str = None, root: str = None):
+    from dialogue_eval.metrics import correlations, ratings_file, read_annotations
+
+    for dataset in datasets:
+        for level in DATASETS[dataset]["levels"]:
+            for tokenizer_name, tokenizer in tokenizers.items():
+                tokens = renderer_tokens(dataset, level, tokenizer, root)
+                saved = 1 - tokens["lines"] / tokens["list"]
+                print(f"{dataset} {level}-level, {tokenizer_name}: list {tokens['list']} tokens, "
+                      f"lines {tokens['lines']} tokens ({saved:.1%} saved)")
+
+            if model_name is None:
+                continue
+            for renderer in RENDERERS:
+                ratings_path, field = ratings_file(model_name, dataset, level, root or ROOT, renderer)
+                if not os.path.exists(ratings_path):
+                    print(f"{dataset} {level}-level, {model_name} {renderer}: no ratings ({ratings_path})")
+                    continue
+                metrics = correlations(*read_annotations(dataset, level, ratings_path, field, root or ROOT))
+                print(f"{dataset} {level}-level, {model_name} {renderer}: "
+                      f"pearson {metrics['pearson_correlation']:.4f}, spearman {metrics['spearman_correlation']:.4f}, "
+                      f"kendall {metrics['kendall_tau_correlation']:.4f}")
+
+
+# Throughput of a model on the prompts of a dataset with worker pools of every configuration ({label:
+# WorkerPoolEngine arguments}), then in this process with the default torch threads, with the deviation of their
+# scores from the single-process ones and the memory of the processes. limit keeps the first prompts only.
+def _pool_benchmark(model_name: str, dataset: str, level: str, configs: dict, limit: int = None, root: str = None,
+                    **engine_kwargs):
+    import time
+
+    from dialogue_eval.engine import InferenceEngine
+    from dialogue_eval.evaluate import build_prompts
+    from dialogue_eval.models import load_model
+    from dialogue_eval.parallel import WorkerPoolEngine, memory_usage
+    from dialogue_eval.topology import available_cpus
+
+    tokenizer, model = load_model(model_name, root or ROOT)
+    weights = sum(tensor.numel() * tensor.element_size() for tensor in model.state_dict().values())
+    prompts = [prompt for _, prompt in build_prompts(dataset, level, root or ROOT)][:limit]
+    sequences = tokenize_prompts(tokenizer, prompts)
+    tokens = sum(len(sequence) for sequence in sequences)
+    print(f"{model_name} on {dataset} {level}-level: {len(sequences)} prompts, {tokens} tokens, "
+          f"{weights / 1024 ** 2:.0f} MiB of weights, {len(available_cpus())} CPUs")
+
+    # The pools are forked first, before this process runs any parallel work.
+    results = {}
+    for label, config in configs.items():
+        engine = WorkerPoolEngine(model, tokenizer, **config, **engine_kwargs)
+        try:
+            start = time.perf_counter()
+            scores = engine.score_ids(sequences, desc=label)
+            results[label] = (time.perf_counter() - start, scores, engine.memory_report())
+        finally:
+            engine.close()
+
+    engine = InferenceEngine(model, tokenizer, **engine_kwargs)
+    start = time.perf_counter()
+    baseline = engine.score_ids(sequences, desc="1 process")
+    elapsed = time.perf_counter() - start
+    print(f"1 process: {len(sequences) / elapsed:.2f} prompts/s, {tokens / elapsed:.0f} tokens/s, "
+          f"peak RSS {memory_usage()['peak_rss'] / 1024 ** 2:.0f} MiB")
+
+    for label, (seconds, scores, memory) in results.items():
+        deviation = max((abs(a[0] - b[0]) for a, b in zip(scores, baseline)), default=0.0)
+        peak = max([memory["parent"]["peak_rss"]] + [usage["peak_rss"] for usage in memory["workers"].values()])
+        print(f"{label}: {len(sequences) / seconds:.2f} prompts/s, {tokens / seconds:.0f} tokens/s "
+              f"({elapsed / seconds:.2f}x), max score deviation {deviation:.1e}, "
+              f"total PSS {memory['total_pss'] / 1024 ** 2:.0f} MiB, peak RSS per process {peak / 1024 ** 2:.0f} MiB")
+    return elapsed, results
+
+
+# Throughput of worker processes sharing the weights of a model against a single process.
+def run_parallel_benchmark(model_name: str, dataset: str, level: str, workers: list, limit: int = None,
+                           root: str = None, **engine_kwargs):
+    return _pool_benchmark(model_name, dataset, level, {f"{count} workers": {"workers": count} for count in workers},
+                           limit, root, **engine_kwargs)
+
+
+# Throughput of one replica per NUMA node, pinned to the CPUs of its node, against as many unpinned workers
+# sharing one copy of the weights and against the default single process.
+def run_numa_benchmark(model_name: str, dataset: str, level: str, limit: int = None, root: str = None,
+                       **engine_kwargs):
+    from dialogue_eval.topology import numa_nodes
+
+    nodes = numa_nodes()
+    for node, cpus in nodes.items():
+        print(f"NUMA node {node}: CPUs {cpus[0]}-{cpus[-1]} ({len(cpus)})")
+    configs = {
+        f"{len(nodes)} pinned replicas": {"cpu_sets": list(nodes.values()), "replicated": len(nodes) > 1},
+        f"{len(nodes)} unpinned workers": {"workers": len(nodes)},
+    }
+    return _pool_benchmark(model_name, dataset, level, configs, limit, root, **engine_kwargs)
+
+
+# Parity and throughput of packed against unpacked scoring of the turn-level prompts of datasets with a
+# Llama-family model (without the prefix cache, so that every prompt goes through packing). limit keeps the first
+# prompts only.
+def run_packing_benchmark(model_name: str, datasets: list, limit: int = None, root: str = None,
+                          pack_tokens: int = 2048, **engine_kwargs):
+    import time
+
+    from dialogue_eval.engine import InferenceEngine
+    from dialogue_eval.evaluate import build_prompts
+    from dialogue_eval.models import load_model
+
+    tokenizer, model = load_model(model_name, root or ROOT)
+    engines = {
+        "unpacked": InferenceEngine(model, tokenizer, prefix_cache_bytes=0, **engine_kwargs),
+        "packed": InferenceEngine(model, tokenizer, prefix_cache_bytes=0, packing=True, pack_tokens=pack_tokens,
+                                  **engine_kwargs),
+    }
+
+    deviations = {}
+    for dataset in datasets:
+        if "turn" not in DATASETS[dataset]["levels"]:
+            continue
+        prompts = [prompt for _, prompt in build_prompts(dataset, "turn", root or ROOT)][:limit]
+        sequences = tokenize_prompts(tokenizer, prompts)
+        lengths = [len(sequence) for sequence in sequences]
+
+        scores = {}
+        for label, engine in engines.items():
+            if label == "packed":
+                groups = engine.packs(lengths)
+                computed = sum(sum(lengths[index] for index in group) for group in groups)
+            else:
+                groups = list(engine.batches(lengths))
+                computed = sum(len(group) * lengths[group[0]] for group in groups)
+            start = time.perf_counter()
+            scores[label] = engine.score_ids(sequences, desc=f"{dataset} {label}")
+            elapsed = time.perf_counter() - start
+            print(f"{dataset} {label}: {len(groups)} forward passes over {computed} tokens "
+                  f"({sum(lengths) / computed:.1%} real), {len(sequences) / elapsed:.2f} prompts/s")
+
+        deviations[dataset] = max(abs(a[0] - b[0]) for a, b in zip(scores["unpacked"], scores["packed"]))
+        print(f"{dataset} max deviation of the packed scores: {deviations[dataset]:.1e}")
+    return deviations
+
+
+# Child process of the load benchmark: load a model (from its converted checkpoint or from its original one), score
+# a short prompt (the first forward pass pages the weights of a memory-mapped checkpoint in), and send the seconds
+# of both and the peak resident memory of the process.
+def _timed_load(model_name: str, converted: bool, dtype: str, root: str, checkpoint_dir: str, results):
+    import time
+
+    from dialogue_eval.checkpoints import load_converted
+    from dialogue_eval.engine import InferenceEngine
+    from dialogue_eval.models import load_model
+    from dialogue_eval.parallel import memory_usage
+
+    try:
+        start = time.perf_counter()
+        if converted:
+            tokenizer, model = load_converted(model_name, dtype, root, checkpoint_dir)
+        else:
+            tokenizer, model = load_model(model_name, root, dtype)
+        loaded = time.perf_counter() - start
+        engine = InferenceEngine(model, tokenizer, prefix_cache_bytes=0)
+        engine.progress = False
+        engine.score(["Is this a test? Answer Yes or No."])
+        results.put((loaded, time.perf_counter() - start, memory_usage()["peak_rss"], None))
+    except Exception as error:
+        results.put((None, None, None, f"{type(error).__name__}: {str(error).splitlines()[0]}"))
+
+
+# Result of target(*args, results) run in a fresh process, which sends it to the results queue.
+def _spawned(target, *args):
+    import multiprocessing
+
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=target, args=(*args, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+# Cold and warm start of every model with a converted checkpoint in a dtype (all the registered models by default),
+# each in a fresh process: time to load, time to the first score and peak RSS. The cold start drops the weights
+# file from the page cache first; the original checkpoint is loaded for comparison when it is available.
+def run_load_benchmark(model_names: list = None, dtype: str = "fp32", root: str = None,
+                       checkpoint_dir: str = None):
+    from dialogue_eval.checkpoints import DEFAULT_DIR, WEIGHTS_FILE, converted_dir, is_converted
+    from dialogue_eval.models import MODELS
+
+    checkpoint_dir = checkpoint_dir or DEFAULT_DIR
+
+    def measure(model_name: str, converted: bool):
+        return _spawned(_timed_load, model_name, converted, dtype, root or ROOT, checkpoint_dir)
+
+    report = {}
+    for model_name in model_names or sorted(MODELS):
+        if not is_converted(model_name, dtype, checkpoint_dir):
+            print(f"{model_name}: no {dtype} converted checkpoint "
+                  f"(python -m dialogue_eval convert --model {model_name} --dtype {dtype})")
+            continue
+
+        weights_path = os.path.join(converted_dir(model_name, dtype, checkpoint_dir), WEIGHTS_FILE)
+        with open(weights_path, 'rb') as weights_file:
+            os.posix_fadvise(weights_file.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+        runs = {"cold": measure(model_name, True), "warm": measure(model_name, True),
+                "original": measure(model_name, False)}
+
+        report[model_name] = runs
+        print(f"{model_name} ({dtype}, {os.path.getsize(weights_path) / 1024 ** 3:.1f} GiB):")
+        for label, (loaded, first_score, peak_rss, error) in runs.items():
+            if error is not None:
+                print(f"  {label}: failed ({error})")
+            else:
+                print(f"  {label}: load {loaded:.2f} s, first score {first_score:.2f} s, "
+                      f"peak RSS {peak_rss / 1024 ** 2:.0f} MiB")
+    return report
+
+
+# Child process of the quantization sweep: load a model (from its converted fp32 checkpoint when there is one),
+# quantize it with a method (None: fp32) and score the first prompts of every (dataset, level) job. Sends the load
+# seconds, the bytes of the weights, the peak resident memory and, per job, the seconds, tokens and scores.
+def _quantized_scores(model_name: str, method: str, jobs: list, limit: int, root: str, quantized_dir: str,
+                      results):
+    import time
+
+    from dialogue_eval.checkpoints import is_converted, load_converted
+    from dialogue_eval.engine import InferenceEngine
+    from dialogue_eval.evaluate import build_prompts
+    from dialogue_eval.models import load_model
+    from dialogue_eval.parallel import memory_usage
+    from dialogue_eval.quantization import load_quantized, weight_bytes
+
+    try:
+        start = time.perf_counter()
+        if is_converted(model_name):
+            tokenizer, model = load_converted(model_name, root=root)
+        else:
+            tokenizer, model = load_model(model_name, root)
+        if method is not None:
+            model = load_quantized(model, model_name, method, quantized_dir=quantized_dir)
+        loaded = time.perf_counter() - start
+
+        engine = InferenceEngine(model, tokenizer)
+        engine.progress = False
+        scores = {}
+        for dataset, level in jobs:
+            prompts = [prompt for _, prompt in build_prompts(dataset, level, root)][:limit]
+            sequences = tokenize_prompts(tokenizer, prompts)
+            start = time.perf_counter()
+            job_scores = engine.score_ids(sequences)
+            scores[(dataset, level)] = (time.perf_counter() - start, sum(len(ids) for ids in sequences), job_scores)
+        results.put((loaded, weight_bytes(model), memory_usage()["peak_rss"], scores, None))
+    except Exception as error:
+        results.put((None, None, None, None, f"{type(error).__name__}: {str(error).splitlines()[0]}"))
+
+
+# Quantization sweep of a model: for fp32 and every quantization method, each in a fresh process, the load time
+# (from the cached quantized weights after the first run), the memory of the weights and the peak RSS, then per
+# dataset and level the throughput and the change of the correlations of the Yes probabilities with the human
+# ratings from fp32. limit keeps the first prompts of every dataset.
+def run_quantization_benchmark(model_name: str, datasets: list, limit: int = None, root: str = None,
+                               methods: list = None, quantized_dir: str = None):
+    from dialogue_eval.datasets import examples
+    from dialogue_eval.metrics import correlations
+    from dialogue_eval.quantization import DEFAULT_DIR, QUANTIZATIONS
+
+    root = root or ROOT
+    jobs = [(dataset, level) for dataset in datasets for level in DATASETS[dataset]["levels"]]
+    runs = {"fp32": _spawned(_quantized_scores, model_name, None, jobs, limit, root, None)}
+    for method in methods or QUANTIZATIONS:
+        runs[method] = _spawned(_quantized_scores, model_name, method, jobs, limit, root, quantized_dir or DEFAULT_DIR)
+
+    baseline = runs["fp32"][3]
+    report = {}
+    for label, (loaded, weights, peak_rss, scores, error) in runs.items():
+        if error is not None:
+            print(f"{model_name} {label}: failed ({error})")
+            continue
+        print(f"{model_name} {label}: load {loaded:.2f} s, weights {weights / 1024 ** 2:.0f} MiB, "
+              f"peak RSS {peak_rss / 1024 ** 2:.0f} MiB")
+        report[label] = {"load_seconds": loaded, "weight_bytes": weights, "peak_rss": peak_rss, "jobs": {}}
+        for (dataset, level), (seconds, tokens, job_scores) in scores.items():
+            human = [example.score for example in examples(dataset, level, os.path.join(root, "_datasets"))]
+            human = human[:len(job_scores)]
+            metrics = correlations(human, [yes for yes, _ in job_scores])
+            line = (f"  {dataset} {level}-level: {len(job_scores) / seconds:.2f} prompts/s, "
+                    f"{tokens / seconds:.0f} tokens/s")
+            if baseline is not None and label != "fp32":
+                reference = correlations(human, [yes for yes, _ in baseline[(dataset, level)][2]])
+                deltas = {name: metrics[name] - reference[name] for name in metrics}
+                deviation = max(abs(a[0] - b[0]) for a, b in zip(job_scores, baseline[(dataset, level)][2]))
+                line += ", " + ", ".join(f"{name} {delta:+.4f}" for name, delta in deltas.items())
+                line += f", max score deviation {deviation:.1e}"
+            else:
+                deltas = None
+            print(line)
+            report[label]["jobs"][f"{dataset}:{level}"] = {"prompts_per_second": len(job_scores) / seconds,
+                                                          "correlations": metrics, "deltas": deltas}
+    return report
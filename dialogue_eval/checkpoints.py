@@ -0,0 +1,161 @@
+import itertools
+import json
+import mmap
+import os
+
+import torch
+from safetensors.torch import save_file
+
+from dialogue_eval.models import DTYPES, ROOT, import_transformers, load_model, model_spec
+
+
+# Default location of the converted checkpoints, in the repository root.
+DEFAULT_DIR = os.path.join(ROOT, ".cache", "checkpoints")
+
+# Weights file of a converted checkpoint, next to its config and tokenizer files.
+WEIGHTS_FILE = "model.safetensors"
+
+_SAFETENSORS_DTYPES = {
+    "F64": torch.float64, "F32": torch.float32, "F16": torch.float16, "BF16": torch.bfloat16, "I64": torch.int64,
+    "I32": torch.int32, "I16": torch.int16, "I8": torch.int8, "U8": torch.uint8, "BOOL": torch.bool,
+}
+
+
+# Directory of the converted checkpoint of a model in a dtype.
+def converted_dir(name: str, dtype: str = "fp32", checkpoint_dir: str = DEFAULT_DIR):
+    return os.path.join(checkpoint_dir, f"{name}-{dtype}")
+
+
+def is_converted(name: str, dtype: str = "fp32", checkpoint_dir: str = DEFAULT_DIR):
+    return os.path.exists(os.path.join(converted_dir(name, dtype, checkpoint_dir), WEIGHTS_FILE))
+
+
+# Convert the checkpoint of a registered evaluator, once: its parameters in the target dtype and its buffers
+# (including the non-persistent ones, like the rotary frequencies, so that loading computes nothing) in a single
+# safetensors file, with the config and tokenizer files next to it. Tied parameters are stored once.
+def convert_model(name: str, dtype: str = "fp32", root: str = ROOT, checkpoint_dir: str = DEFAULT_DIR):
+    if dtype not in DTYPES:
+        raise ValueError(f"Unknown dtype '{dtype}', expected one of {sorted(DTYPES)}")
+    tokenizer, model = load_model(name, root, dtype)
+    with torch.no_grad():
+        for parameter in model.parameters():
+            parameter.data = parameter.data.to(getattr(torch, DTYPES[dtype]))
+
+    tensors = {}
+    aliases = {}
+    stored = {}
+    for tensor_name, tensor in itertools.chain(model.named_parameters(remove_duplicate=False),
+                                               model.named_buffers(remove_duplicate=False)):
+        if id(tensor) in stored:
+            aliases[tensor_name] = stored[id(tensor)]
+            continue
+        stored[id(tensor)] = tensor_name
+        tensors[tensor_name] = tensor.detach().contiguous()
+
+    directory = converted_dir(name, dtype, checkpoint_dir)
+    os.makedirs(directory, exist_ok=True)
+    model.config.save_pretrained(directory)
+    tokenizer.save_pretrained(directory)
+    metadata = {
+        "format": "pt", "model": name, "checkpoint": model_spec(name)["checkpoint"],
+        "commit_hash": getattr(model.config, "_commit_hash", None) or "", "dtype": dtype,
+        "aliases": json.dumps(aliases),
+    }
+    file_path = os.path.join(directory, WEIGHTS_FILE)
+    save_file(tensors, f"{file_path}.tmp", metadata)
+    os.replace(f"{file_path}.tmp", file_path)
+    return file_path
+
+
+# Byte ranges of the tensors of a memory-mapped weights file, by name, to tell the kernel which of them to read
+# ahead or to drop from memory (they are read again from the file when they are used next).
+class MappedWeights:
+
+    def __init__(self, buffer: mmap.mmap, ranges: dict):
+        self.buffer = buffer
+        self.ranges = ranges
+
+    def _advise(self, advice: int, names: list):
+        for name in names:
+            begin, end = self.ranges[name]
+            start = begin - begin % mmap.PAGESIZE
+            if end > start:
+                self.buffer.madvise(advice, start, end - start)
+
+    def prefetch(self, names: list):
+        self._advise(mmap.MADV_WILLNEED, names)
+
+    def release(self, names: list):
+        self._advise(mmap.MADV_DONTNEED, names)
+
+
+# Tensors of a safetensors file, backed by a private memory map of it: nothing is read until a tensor is used,
+# pages come from the page cache (shared with the other processes reading the file), and writing to a tensor
+# copies its page instead of changing the file. Returns the tensors, the metadata of the file and its MappedWeights.
+def read_safetensors(file_path: str):
+    with open(file_path, 'rb') as weights_file:
+        header_size = int.from_bytes(weights_file.read(8), "little")
+        header = json.loads(weights_file.read(header_size))
+        buffer = mmap.mmap(weights_file.fileno(), 0, access=mmap.ACCESS_COPY)
+
+    metadata = header.pop("__metadata__", {})
+    start = 8 + header_size
+    tensors = {}
+    ranges = {}
+    for name, info in header.items():
+        dtype = _SAFETENSORS_DTYPES[info["dtype"]]
+        begin, end = info["data_offsets"]
+        ranges[name] = (start + begin, start + end)
+        count = (end - begin) // dtype.itemsize
+        if count == 0:
+            tensors[name] = torch.empty(info["shape"], dtype=dtype)
+        else:
+            tensors[name] = torch.frombuffer(buffer, dtype=dtype, count=count, offset=start + begin).view(info["shape"])
+    return tensors, metadata, MappedWeights(buffer, ranges)
+
+
+# Set a parameter or buffer of a model, by its dotted name.
+def _assign(model, name: str, tensor):
+    module_name, _, attribute = name.rpartition(".")
+    module = model.get_submodule(module_name)
+    if attribute in module._parameters:
+        if not isinstance(tensor, torch.nn.Parameter):
+            tensor = torch.nn.Parameter(tensor, requires_grad=False)
+        module._parameters[attribute] = tensor
+    elif attribute in module._buffers:
+        module._buffers[attribute] = tensor
+    else:
+        raise RuntimeError(f"The model has no parameter or buffer '{name}'")
+
+
+# Load the converted checkpoint of a registered evaluator: the model is built on the meta device (no memory, no
+# weight initialization) and its parameters and buffers are the memory-mapped tensors of the weights file, paged
+# in by the first forward pass. The MappedWeights of the file are kept in model.mapped_weights.
+def load_converted(name: str, dtype: str = "fp32", root: str = ROOT, checkpoint_dir: str = DEFAULT_DIR):
+    spec = model_spec(name)
+    transformers = import_transformers(name, root)
+    directory = converted_dir(name, dtype, checkpoint_dir)
+    kwargs = {key: value for key, value in spec["kwargs"].items() if key == "trust_remote_code"}
+
+    tokenizer = transformers.AutoTokenizer.from_pretrained(directory, **kwargs)
+    config = transformers.AutoConfig.from_pretrained(directory, **kwargs)
+    with torch.device("meta"):
+        model = getattr(transformers, spec["auto_class"]).from_config(config, **kwargs)
+
+    tensors, metadata, weights = read_safetensors(os.path.join(directory, WEIGHTS_FILE))
+    for tensor_name, tensor in tensors.items():
+        _assign(model, tensor_name, tensor)
+    for alias, target in json.loads(metadata.get("aliases", "{}")).items():
+        _assign(model, alias, model.get_parameter(target) if target in dict(model.named_parameters())
+                else model.get_buffer(target))
+
+    missing = [tensor_name for tensor_name, tensor in itertools.chain(model.named_parameters(), model.named_buffers())
+               if tensor.is_meta]
+    if missing:
+        raise RuntimeError(f"The converted checkpoint of '{name}' lacks {missing[:5]}; convert it again")
+
+    # Same score cache namespace as the original checkpoint in this dtype.
+    model.config._name_or_path = metadata.get("checkpoint", spec["checkpoint"])
+    model.config._commit_hash = metadata.get("commit_hash") or None
+    model.mapped_weights = weights
+    return tokenizer, model.eval()
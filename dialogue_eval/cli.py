@@ -0,0 +1,241 @@
+import argparse
+
+from dialogue_eval.batch_budget import DEFAULT_PATH as BATCH_BUDGETS_PATH
+from dialogue_eval.checkpoints import DEFAULT_DIR as CHECKPOINT_DIR
+from dialogue_eval.datasets import DATASETS, LEVELS
+from dialogue_eval.engine import MODES
+from dialogue_eval.models import DTYPES, MODELS
+from dialogue_eval.prompts import RENDERERS
+from dialogue_eval.quantization import DEFAULT_DIR as QUANTIZED_DIR, QUANTIZATIONS
+from dialogue_eval.score_cache import DEFAULT_PATH
+from dialogue_eval.token_cache import DEFAULT_DIR
+from dialogue_eval.truncation import TruncationPolicy
+
+
+# Comma-separated list of names.
+def _names(value: str):
+    return [name.strip() for name in value.split(",") if name.strip()]
+
+
+# Integer of at least 1, checked before any model is loaded.
+def _positive_int(value: str):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"expected a positive integer, got {value}")
+    return number
+
+
+# Token caps of the prompts, shared by the commands that build or read results of truncated prompts.
+def _add_truncation_arguments(parser):
+    parser.add_argument("--max-prompt-tokens", type=int,
+                        help="drop the oldest turns of the context until the prompt has at most this many tokens")
+    parser.add_argument("--max-turn-tokens", type=int,
+                        help="keep the last tokens of every turn of the context, at most this many")
+
+
+def _truncation(args):
+    return TruncationPolicy(args.max_prompt_tokens, args.max_turn_tokens)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="python -m dialogue_eval",
+                                     description="Automatic dialogue evaluation with LLMs.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    evaluate_parser = subparsers.add_parser("evaluate", help="Score datasets with a local LLM, loading it once.")
+    evaluate_parser.add_argument("--model", required=True, choices=sorted(MODELS))
+    evaluate_parser.add_argument("--datasets", type=_names, default=list(DATASETS),
+                                 help=f"comma-separated datasets among {','.join(DATASETS)} (default: all)")
+    evaluate_parser.add_argument("--level", type=_names, default=list(LEVELS),
+                                 help="comma-separated levels among turn,dialogue (default: both)")
+    evaluate_parser.add_argument("--checkpoint-dir", default=CHECKPOINT_DIR,
+                                 help="directory of the converted checkpoints, used when the model has one")
+    evaluate_parser.add_argument("--no-converted", dest="checkpoint_dir", action="store_const", const=None,
+                                 help="load the original checkpoint even when a converted one exists")
+    evaluate_parser.add_argument("--dtype", choices=list(DTYPES), default="fp32",
+                                 help="dtype of the weights (bf16 and fp16 halve their memory)")
+    evaluate_parser.add_argument("--quantization", choices=list(QUANTIZATIONS) + ["none"],
+                                 help="quantized linear layers (default: the registry quantization of the model)")
+    evaluate_parser.add_argument("--quantized-dir", default=QUANTIZED_DIR, help="directory of the quantized weights")
+    evaluate_parser.add_argument("--max-drift", type=float, default=0.02,
+                                 help="largest change of a correlation from the fp32 one allowed to a "
+                                      "reduced-precision or quantized run")
+    evaluate_parser.add_argument("--stream-layers", type=_positive_int, metavar="WINDOW",
+                                 help="run the decoder layers one at a time from the memory-mapped converted "
+                                      "checkpoint, reading WINDOW layers ahead, for models larger than the memory")
+    evaluate_parser.add_argument("--stream-tokens", type=int, default=65536,
+                                 help="padded tokens whose hidden states go through a layer before the next one "
+                                      "(with --stream-layers)")
+    evaluate_parser.add_argument("--batch-size", type=_positive_int, default=8)
+    evaluate_parser.add_argument("--max-batch-tokens", type=int, default=8192,
+                                 help="padded tokens per batch (rows x longest prompt), lowered when a batch fails "
+                                      "to allocate")
+    evaluate_parser.add_argument("--batch-budgets", default=BATCH_BUDGETS_PATH,
+                                 help="JSON file of the batch token budgets learned per model")
+    evaluate_parser.add_argument("--no-batch-budgets", dest="batch_budgets", action="store_const", const=None,
+                                 help="neither read nor keep the learned batch token budgets")
+    evaluate_parser.add_argument("--mode", choices=MODES, default="restricted",
+                                 help="LM head over the full vocabulary or the Yes/No tokens only")
+    evaluate_parser.add_argument("--packing", action="store_true",
+                                 help="concatenate prompts into sequences with a block-diagonal mask (Llama family)")
+    evaluate_parser.add_argument("--pack-tokens", type=int, default=2048, help="tokens per packed sequence")
+    evaluate_parser.add_argument("--prefix-cache-bytes", type=int, default=2 * 1024 ** 3,
+                                 help="memory for the KV cache of shared prompt prefixes (0 disables it)")
+    evaluate_parser.add_argument("--prefetch", type=_positive_int, default=1,
+                                 help="chunks of prompts loaded, rendered and tokenized ahead of the one being scored")
+    evaluate_parser.add_argument("--chunk-size", type=_positive_int, default=256,
+                                 help="prompts tokenized and scored at a time, so that scoring starts on the first "
+                                      "chunk of a dataset")
+    evaluate_parser.add_argument("--flush-every", type=_positive_int, default=64,
+                                 help="scored examples buffered before they are appended to the results journal")
+    evaluate_parser.add_argument("--no-resume", dest="resume", action="store_false",
+                                 help="discard the results journal instead of skipping the examples it holds")
+    evaluate_parser.add_argument("--report", help="JSON file of the run report (model load time, time per dataset)")
+    evaluate_parser.add_argument("--score-cache", default=DEFAULT_PATH, help="SQLite cache of the prompt scores")
+    evaluate_parser.add_argument("--score-cache-bytes", type=int, default=1024 ** 3,
+                                 help="size of the score cache before eviction (0 disables it)")
+    evaluate_parser.add_argument("--token-cache", default=DEFAULT_DIR,
+                                 help="directory of the memory-mapped token ids of the prompts")
+    evaluate_parser.add_argument("--no-token-cache", dest="token_cache", action="store_const", const=None,
+                                 help="tokenize the prompts on every run")
+    evaluate_parser.add_argument("--renderer", choices=RENDERERS, default="list",
+                                 help="layout of the turns: Python list (original prompts) or a line per speaker turn")
+    _add_truncation_arguments(evaluate_parser)
+    evaluate_parser.add_argument("--workers", type=_positive_int, default=1,
+                                 help="worker processes sharing the loaded model copy-on-write (1: score in-process)")
+    evaluate_parser.add_argument("--threads-per-worker", type=_positive_int,
+                                 help="torch threads of every worker (default: available CPUs / workers)")
+    evaluate_parser.add_argument("--numa", action="store_true",
+                                 help="one model replica per NUMA node, pinned to its CPUs (replaces --workers)")
+    evaluate_parser.add_argument("--threads", type=int, help="torch intra-op threads of a single-process run")
+    evaluate_parser.add_argument("--interop-threads", type=int, help="torch inter-op threads of a single-process run")
+
+    convert_parser = subparsers.add_parser("convert", help="Convert checkpoints to a single memory-mapped file.")
+    convert_parser.add_argument("--model", type=_names, required=True,
+                                help=f"comma-separated models among {','.join(sorted(MODELS))}")
+    convert_parser.add_argument("--dtype", choices=list(DTYPES), default="fp32", help="dtype of the weights")
+    convert_parser.add_argument("--checkpoint-dir", default=CHECKPOINT_DIR)
+
+    tokenize_parser = subparsers.add_parser("tokenize", help="Tokenize the prompts of datasets into the token cache.")
+    tokenize_parser.add_argument("--model", required=True, choices=sorted(MODELS))
+    tokenize_parser.add_argument("--datasets", type=_names, default=list(DATASETS))
+    tokenize_parser.add_argument("--level", type=_names, default=list(LEVELS))
+    tokenize_parser.add_argument("--token-cache", default=DEFAULT_DIR)
+    tokenize_parser.add_argument("--renderer", choices=RENDERERS, default="list")
+    _add_truncation_arguments(tokenize_parser)
+
+    metrics_parser = subparsers.add_parser("metrics", help="Correlate the ratings of a model with the human ratings.")
+    metrics_parser.add_argument("--model", required=True, choices=sorted(MODELS))
+    metrics_parser.add_argument("--datasets", type=_names, default=list(DATASETS),
+                                help=f"comma-separated datasets among {','.join(DATASETS)} (default: all)")
+    metrics_parser.add_argument("--level", type=_names, default=list(LEVELS),
+                                help="comma-separated levels among turn,dialogue (default: both)")
+    metrics_parser.add_argument("--renderer", choices=RENDERERS, default="list")
+    metrics_parser.add_argument("--dtype", choices=list(DTYPES), default="fp32")
+    metrics_parser.add_argument("--quantization", choices=QUANTIZATIONS)
+    _add_truncation_arguments(metrics_parser)
+
+    cache_parser = subparsers.add_parser("cache", help="Inspect the score cache.")
+    cache_parser.add_argument("action", choices=["stats"])
+    cache_parser.add_argument("--path", default=DEFAULT_PATH)
+
+    bench_parser = subparsers.add_parser("bench", help="Run a benchmark.")
+    bench_parser.add_argument("benchmark", choices=["prompts", "renderers", "parallel", "numa", "packing", "load",
+                                                         "quantization"],
+                              help="prompts: token count per example over repeated passes on the same data; "
+                                   "renderers: tokens saved by the lines renderer and correlations of its ratings; "
+                                   "parallel: throughput of worker processes against a single process; "
+                                   "numa: throughput of pinned replicas per NUMA node against unpinned runs; "
+                                   "packing: parity and throughput of packed against padded turn-level batches; "
+                                   "load: cold and warm start of the converted checkpoints; "
+                                   "quantization: throughput, memory and correlations of the quantized models")
+    bench_parser.add_argument("--datasets", type=_names, default=list(DATASETS))
+    bench_parser.add_argument("--repeats", type=int, default=5)
+    bench_parser.add_argument("--tokenizer", type=_names, default=[],
+                              help="comma-separated registered models or tokenizer paths (default: whitespace words)")
+    bench_parser.add_argument("--model", choices=sorted(MODELS),
+                              help="renderers: model whose ratings with both renderers are correlated; "
+                                   "parallel, numa, packing, quantization: model to run; "
+                                   "load: model to load (default: all)")
+    bench_parser.add_argument("--level", default="turn", choices=LEVELS,
+                              help="parallel, numa: level of the first dataset")
+    bench_parser.add_argument("--workers", type=_names, default=["2", "4"],
+                              help="parallel: comma-separated numbers of worker processes")
+    bench_parser.add_argument("--limit", type=int, help="parallel, numa, packing, quantization: number of prompts")
+    bench_parser.add_argument("--dtype", choices=list(DTYPES), default="fp32",
+                              help="load: dtype of the converted checkpoints")
+
+    return parser
+
+
+def main(argv: list = None):
+    args = build_parser().parse_args(argv)
+
+    if args.command == "evaluate":
+        from dialogue_eval.evaluate import evaluate
+        evaluate(args.model, args.datasets, args.level, batch_size=args.batch_size,
+                 max_batch_tokens=args.max_batch_tokens, mode=args.mode, packing=args.packing,
+                 pack_tokens=args.pack_tokens, prefix_cache_bytes=args.prefix_cache_bytes,
+                 flush_every=args.flush_every, resume=args.resume, score_cache_path=args.score_cache,
+                 score_cache_bytes=args.score_cache_bytes, token_cache_dir=args.token_cache, renderer=args.renderer,
+                 truncation=_truncation(args), workers=args.workers, threads_per_worker=args.threads_per_worker,
+                 numa=args.numa, threads=args.threads, interop_threads=args.interop_threads,
+                 batch_budgets_path=args.batch_budgets, prefetch=args.prefetch, chunk_size=args.chunk_size,
+                 report_path=args.report, checkpoint_dir=args.checkpoint_dir, dtype=args.dtype,
+                 max_drift=args.max_drift, quantization=args.quantization, quantized_dir=args.quantized_dir,
+                 stream_layers=args.stream_layers, stream_tokens=args.stream_tokens)
+
+    elif args.command == "convert":
+        from dialogue_eval.checkpoints import convert_model
+        for model_name in args.model:
+            print(f"{model_name}: {convert_model(model_name, args.dtype, checkpoint_dir=args.checkpoint_dir)}")
+
+    elif args.command == "tokenize":
+        from dialogue_eval.evaluate import build_token_cache
+        build_token_cache(args.model, args.datasets, args.level, token_cache_dir=args.token_cache,
+                          renderer=args.renderer, truncation=_truncation(args))
+
+    elif args.command == "metrics":
+        from dialogue_eval.metrics import metrics
+        metrics(args.model, args.datasets, args.level, renderer=args.renderer, truncation=_truncation(args),
+                dtype=args.dtype, quantization=args.quantization)
+
+    elif args.command == "cache":
+        from dialogue_eval.score_cache import ScoreCache
+        score_cache = ScoreCache(args.path)
+        stats = score_cache.stats()
+        score_cache.close()
+
+        print(f"Score cache: {stats['path']}")
+        print(f"Entries: {stats['entries']} ({stats['bytes'] / 1024 ** 2:.1f} MiB)")
+        print(f"Lookups: {stats['hits'] + stats['misses']} ({stats['hits']} hits, {stats['misses']} misses)")
+        print(f"Hit rate: {stats['hit_rate']:.1%}")
+
+    elif args.command == "bench":
+        from dialogue_eval.bench import (run_load_benchmark, run_numa_benchmark, run_packing_benchmark,
+                                         run_parallel_benchmark, run_prompt_tokens_benchmark,
+                                         run_quantization_benchmark, run_renderer_report)
+        from dialogue_eval.models import load_tokenizer
+        tokenizers = {name: load_tokenizer(name) for name in args.tokenizer} or {"whitespace words": None}
+
+        if args.benchmark == "prompts":
+            for tokenizer_name, tokenizer in tokenizers.items():
+                print(f"Tokenizer: {tokenizer_name}")
+                if not run_prompt_tokens_benchmark(args.datasets, args.repeats, tokenizer):
+                    raise SystemExit("Prompt token counts changed across passes")
+        elif args.benchmark in ("parallel", "numa", "packing", "quantization"):
+            if args.model is None:
+                raise SystemExit(f"bench {args.benchmark} needs --model")
+            if args.benchmark == "parallel":
+                run_parallel_benchmark(args.model, args.datasets[0], args.level,
+                                       [int(count) for count in args.workers], args.limit)
+            elif args.benchmark == "numa":
+                run_numa_benchmark(args.model, args.datasets[0], args.level, args.limit)
+            elif args.benchmark == "packing":
+                run_packing_benchmark(args.model, args.datasets, args.limit)
+            else:
+                run_quantization_benchmark(args.model, args.datasets, args.limit)
+        elif args.benchmark == "load":
+            run_load_benchmark([args.model] if args.model else None, args.dtype)
+        else:
+            run_renderer_report(args.datasets, tokenizers, args.model)
@@ -0,0 +1,71 @@
+import functools
+import json
+import os
+import pickle
+
+from dialogue_eval.adapters import convai2, dstc9, fed, usr
+from dialogue_eval.models import ROOT
+
+
+# Datasets in _datasets, with the adapter parsing them into examples per evaluation level.
+# DSTC9 is evaluated over several runs whose ratings are averaged.
+DATASETS = {
+    "fed": {"file": fed.FILE, "levels": fed.LEVELS},
+    "pc_usr": {"file": usr.FILES["pc_usr"], "levels": usr.LEVELS},
+    "tc_usr": {"file": usr.FILES["tc_usr"], "levels": usr.LEVELS},
+    "convai2": {"file": convai2.FILE, "levels": convai2.LEVELS},
+    "dstc9": {"file": dstc9.FILE, "levels": dstc9.LEVELS, "runs": 5},
+}
+
+LEVELS = ("turn", "dialogue")
+
+# Version of the normalized form, changed with the adapters so that stale cached forms are not read.
+NORMALIZED_VERSION = 2
+
+# Directory of the cached normalized forms, in the repository root.
+CACHE_DIR = os.path.join(ROOT, ".cache", "datasets")
+
+
+# Load a dataset file.
+def load_dataset(name: str, datasets_dir: str):
+    with open(os.path.join(datasets_dir, DATASETS[name]["file"]), 'r') as file:
+        return json.load(file)
+
+
+# Examples of loaded dataset data at an evaluation level.
+def build_examples(name: str, level: str, data):
+    if level not in DATASETS[name]["levels"]:
+        raise ValueError(f"Dataset '{name}' has no {level}-level evaluation")
+    return list(DATASETS[name]["levels"][level](data))
+
+
+# Examples of a dataset at every level it has, parsed once per file version.
+# The normalized form is pickled in CACHE_DIR, keyed by the size and modification time of the file, so the JSON
+# is only parsed again when it changes.
+@functools.lru_cache(maxsize=None)
+def _normalized(name: str, file_path: str, size: int, mtime_ns: int):
+    cache_path = os.path.join(CACHE_DIR, f"{name}-v{NORMALIZED_VERSION}-{size}-{mtime_ns}.pickle")
+    if os.path.exists(cache_path):
+        with open(cache_path, 'rb') as cache_file:
+            return pickle.load(cache_file)
+
+    with open(file_path, 'r') as file:
+        data = json.load(file)
+    normalized = {level: tuple(build_examples(name, level, data)) for level in DATASETS[name]["levels"]}
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmp_path = f"{cache_path}.tmp"
+    with open(tmp_path, 'wb') as cache_file:
+        pickle.dump(normalized, cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, cache_path)
+    return normalized
+
+
+# Examples of a dataset at an evaluation level.
+def examples(name: str, level: str, datasets_dir: str):
+    if level not in DATASETS[name]["levels"]:
+        raise ValueError(f"Dataset '{name}' has no {level}-level evaluation")
+
+    file_path = os.path.abspath(os.path.join(datasets_dir, DATASETS[name]["file"]))
+    stat = os.stat(file_path)
+    return _normalized(name, file_path, stat.st_size, stat.st_mtime_ns)[level]
@@ -0,0 +1,406 @@
+import functools
+import inspect
+
+import torch
+from tqdm import tqdm
+
+from dialogue_eval.batch_budget import is_out_of_memory, release_memory
+from dialogue_eval.prefix_cache import PrefixCache, repeat_past
+from dialogue_eval.score_cache import cache_key, cache_namespace
+from dialogue_eval.templates import tokenize_prompts
+from dialogue_eval.scoring import (label_head, label_log_probs, label_token_ids, last_logits_kwargs, normalize,
+                                   swapped_output_layer)
+
+
+# Scoring modes: full-vocabulary logits, or logits of the label tokens only.
+MODES = ("full", "restricted")
+
+# Models whose decoder takes a 4D attention mask and position ids as they are, so that prompts can be packed.
+PACKED_MODEL_TYPES = ("llama",)
+
+
+# Whether the forward of the model accepts the given argument.
+@functools.lru_cache(maxsize=None)
+def _accepts(model_class, argument: str):
+    return argument in inspect.signature(model_class.forward).parameters
+
+
+# Padding id of the tokenizer (Llama tokenizers have no pad token, any id works since pads are masked).
+def _pad_token_id(tokenizer):
+    for token_id in (tokenizer.pad_token_id, tokenizer.eos_token_id, tokenizer.unk_token_id):
+        if token_id is not None:
+            return token_id
+    return 0
+
+
+# Batched Yes/No scoring of prompts, grouped by token length and left-padded.
+# A batch that fails to allocate is split in halves and retried, and the budget of padded tokens per batch is
+# lowered below it; with batch budgets, the lowered budget of the model is kept for its next runs.
+# The restricted mode projects the final hidden states only on the LM head rows of the labels; it is checked
+# against the full-vocabulary scores on one batch and must match them within tolerance.
+# With packing (Llama-family models), the prompts without a cached prefix are concatenated into sequences of at
+# most pack_tokens tokens instead of padded batches, with a block-diagonal causal mask and positions restarting at
+# every prompt; the first pack is checked against unpacked scoring within the same tolerance.
+class InferenceEngine:
+
+    def __init__(self, model, tokenizer, label_ids: list = None, batch_size: int = 8, max_batch_tokens: int = 8192,
+                 mode: str = "restricted", tolerance: float = 1e-4, prefix_cache_bytes: int = 2 * 1024 ** 3,
+                 score_cache=None, batch_budgets=None, packing: bool = False, pack_tokens: int = 2048):
+        if batch_size < 1 or max_batch_tokens < 1 or pack_tokens < 1:
+            raise ValueError("batch_size, max_batch_tokens and pack_tokens must be positive")
+        if mode not in MODES:
+            raise ValueError(f"Unknown scoring mode '{mode}', expected one of {MODES}")
+        model_type = getattr(model.config, "model_type", None)
+        if packing and model_type not in PACKED_MODEL_TYPES:
+            raise ValueError(f"Packing needs a model among {PACKED_MODEL_TYPES}, not '{model_type}'")
+
+        self.model = model
+        self.tokenizer = tokenizer
+        self.label_ids = label_ids if label_ids is not None else label_token_ids(tokenizer)
+        self.batch_size = batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.pad_token_id = _pad_token_id(tokenizer)
+        self.mode = mode
+        self.tolerance = tolerance
+        self.label_head = label_head(model, self.label_ids) if mode == "restricted" else None
+        self.verified = mode == "full"
+        self.prefix_cache = PrefixCache(prefix_cache_bytes) if prefix_cache_bytes > 0 else None
+        self.score_cache = score_cache
+        self.cache_namespace = cache_namespace(model, mode, self.label_ids)
+        self.progress = True
+        # Prompts scored by forward passes (not read from the score cache), over the life of the engine.
+        self.forwarded = 0
+        self.packing = packing
+        self.pack_tokens = pack_tokens
+        self.packing_verified = not packing
+
+        self.batch_budgets = batch_budgets
+        learned = batch_budgets.get(self.cache_namespace) if batch_budgets is not None else None
+        if learned is not None:
+            self.max_batch_tokens = min(self.max_batch_tokens, learned)
+
+    # Token ids of the prompts, as tokenizer.encode(prompt, add_special_tokens=False).
+    def tokenize(self, prompts: list):
+        return tokenize_prompts(self.tokenizer, prompts)
+
+    # Indices of the sequences grouped in batches of similar length, longest first.
+    # A batch holds at most batch_size rows and max_batch_tokens padded tokens (a longer sequence is scored alone).
+    def batches(self, lengths: list):
+        order = sorted(range(len(lengths)), key=lambda index: lengths[index], reverse=True)
+
+        batch = []
+        for index in order:
+            # The first sequence of a batch is the longest one, so it sets the padded width.
+            if batch and (len(batch) == self.batch_size
+                          or (len(batch) + 1) * lengths[batch[0]] > self.max_batch_tokens):
+                yield batch
+                batch = []
+            batch.append(index)
+
+        if batch:
+            yield batch
+
+    # Indices of the sequences packed by first-fit decreasing length: every pack holds at most pack_tokens tokens
+    # (a longer sequence is packed alone).
+    def packs(self, lengths: list):
+        packs = []
+        room = []
+        for index in sorted(range(len(lengths)), key=lambda index: lengths[index], reverse=True):
+            for pack, free in enumerate(room):
+                if lengths[index] <= free:
+                    packs[pack].append(index)
+                    room[pack] -= lengths[index]
+                    break
+            else:
+                packs.append([index])
+                room.append(self.pack_tokens - lengths[index])
+        return packs
+
+    # Left-padded input ids and attention mask of a batch.
+    def collate(self, sequences: list):
+        width = max(len(sequence) for sequence in sequences)
+        input_ids = torch.full((len(sequences), width), self.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(sequences), width), dtype=torch.long)
+
+        for row, sequence in enumerate(sequences):
+            input_ids[row, width - len(sequence):] = torch.as_tensor(sequence, dtype=torch.long)
+            attention_mask[row, width - len(sequence):] = 1
+
+        return input_ids, attention_mask
+
+    # Logits of a forward pass and the ids of the labels in them.
+    # In restricted mode the logits cover the labels only, which leaves the normalized scores unchanged.
+    def run_model(self, input_ids: torch.Tensor, mode: str = None, **kwargs):
+        mode = mode or self.mode
+        with torch.no_grad():
+            if mode == "restricted":
+                with swapped_output_layer(self.model, self.label_head):
+                    return self.model(input_ids=input_ids, **kwargs).logits, list(range(len(self.label_ids)))
+            return self.model(input_ids=input_ids, **kwargs).logits, self.label_ids
+
+    # Label log-probabilities of the given rows of the logits, one (yes, no) pair per row.
+    def row_log_probs(self, logits: torch.Tensor, positions: torch.Tensor, label_ids: list):
+        yes_log_probs, no_log_probs = label_log_probs(logits[torch.arange(len(positions)), positions], label_ids)
+        return list(zip(yes_log_probs.tolist(), no_log_probs.tolist()))
+
+    # Label log-probabilities of a batch of sequences.
+    def forward(self, sequences: list, mode: str = None):
+        input_ids, attention_mask = self.collate(sequences)
+
+        kwargs = {"attention_mask": attention_mask, "use_cache": False}
+        if _accepts(type(self.model), "position_ids"):
+            # Positions restart at the first non-pad token of each row.
+            kwargs["position_ids"] = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+        kwargs.update(last_logits_kwargs(self.model))
+
+        logits, label_ids = self.run_model(input_ids, mode, **kwargs)
+
+        # Last non-pad position of each row (the model may return only the trailing positions).
+        last_positions = attention_mask.shape[1] - 1 - attention_mask.flip(-1).argmax(-1)
+        return self.row_log_probs(logits, last_positions - (input_ids.shape[1] - logits.shape[1]), label_ids)
+
+    # Label log-probabilities of sequences concatenated into one: a block-diagonal causal mask keeps every token
+    # within its own sequence, positions restart at every sequence, and the LM head only runs on the last token of
+    # every sequence.
+    def forward_packed(self, sequences: list, mode: str = None):
+        mode = mode or self.mode
+        lengths = torch.as_tensor([len(sequence) for sequence in sequences])
+        input_ids = torch.cat([torch.as_tensor(sequence, dtype=torch.long) for sequence in sequences]).unsqueeze(0)
+        segments = torch.repeat_interleave(torch.arange(len(sequences)), lengths)
+        position_ids = torch.cat([torch.arange(length) for length in lengths.tolist()]).unsqueeze(0)
+
+        # Additive mask of shape (batch, heads, queries, keys), as the decoder takes a prepared 4D mask.
+        causal = torch.ones(len(segments), len(segments), dtype=torch.bool).tril()
+        allowed = causal & (segments[:, None] == segments[None, :])
+        dtype = self.model.dtype
+        attention_mask = torch.zeros(1, 1, len(segments), len(segments), dtype=dtype)
+        attention_mask.masked_fill_(~allowed, torch.finfo(dtype).min)
+
+        with torch.no_grad():
+            hidden_states = self.model.get_decoder()(input_ids=input_ids, attention_mask=attention_mask,
+                                                     position_ids=position_ids, use_cache=False).last_hidden_state
+            last_hidden_states = hidden_states[0, lengths.cumsum(0) - 1]
+            if mode == "restricted":
+                logits, label_ids = self.label_head(last_hidden_states), list(range(len(self.label_ids)))
+            else:
+                logits, label_ids = self.model.get_output_embeddings()(last_hidden_states), self.label_ids
+
+        yes_log_probs, no_log_probs = label_log_probs(logits, label_ids)
+        return list(zip(yes_log_probs.tolist(), no_log_probs.tolist()))
+
+    # Check that packed scoring gives the scores of unpacked batches of the same sequences.
+    def verify_packing(self, sequences: list):
+        unpacked = self.run_adaptive(self.forward, sequences)
+        packed = self.forward_packed(sequences)
+
+        deviation = max(abs(normalize(*a)[0] - normalize(*b)[0]) for a, b in zip(unpacked, packed))
+        if deviation > self.tolerance:
+            raise ValueError(f"Packed scoring deviates from unpacked scoring by {deviation:.2e} "
+                             f"(tolerance {self.tolerance:.0e})")
+        self.packing_verified = True
+        return deviation
+
+    # past_key_values of a prefix, run once.
+    def prefix_past(self, prefix: list):
+        input_ids = torch.as_tensor(prefix, dtype=torch.long).unsqueeze(0)
+        with torch.no_grad():
+            return self.model(input_ids=input_ids, use_cache=True, **last_logits_kwargs(self.model)).past_key_values
+
+    # Label log-probabilities of a batch of suffixes of a prefix whose past_key_values are given.
+    # Suffixes are right-padded: with causal attention no real token sees a pad, and positions simply continue
+    # after the prefix, also for models that ignore position_ids.
+    def forward_suffixes(self, past, prefix_length: int, suffixes: list):
+        width = max(len(suffix) for suffix in suffixes)
+        input_ids = torch.full((len(suffixes), width), self.pad_token_id, dtype=torch.long)
+        attention_mask = torch.ones((len(suffixes), prefix_length + width), dtype=torch.long)
+        for row, suffix in enumerate(suffixes):
+            input_ids[row, :len(suffix)] = torch.as_tensor(suffix, dtype=torch.long)
+            attention_mask[row, prefix_length + len(suffix):] = 0
+
+        batch_dim = 1 if getattr(self.model.config, "model_type", None) == "chatglm" else 0
+        kwargs = {"attention_mask": attention_mask, "past_key_values": repeat_past(past, len(suffixes), batch_dim),
+                  "use_cache": False}
+        if _accepts(type(self.model), "position_ids"):
+            kwargs["position_ids"] = torch.arange(prefix_length, prefix_length + width).expand(len(suffixes), -1)
+
+        logits, label_ids = self.run_model(input_ids, **kwargs)
+        last_positions = torch.as_tensor([len(suffix) - 1 for suffix in suffixes])
+        return self.row_log_probs(logits, last_positions, label_ids)
+
+    # Lower the budget of padded tokens per batch, and keep it for the next runs of the model.
+    def lower_budget(self, budget: int):
+        self.max_batch_tokens = max(1, min(self.max_batch_tokens, budget))
+        if self.batch_budgets is not None:
+            self.batch_budgets.lower(self.cache_namespace, self.max_batch_tokens)
+
+    # Result of run(rows) for a batch of token id rows, concatenated over halves of the batch when it fails to
+    # allocate (down to single rows, whose failure is raised). offset is the number of tokens before every row (a
+    # cached prefix).
+    def run_adaptive(self, run, rows: list, offset: int = 0):
+        try:
+            return run(rows)
+        except Exception as error:
+            if len(rows) == 1 or not is_out_of_memory(error):
+                raise
+
+        # Outside the except block, so that the tensors of the failed forward pass can be freed.
+        release_memory()
+        padded = len(rows) * (offset + max(len(row) for row in rows))
+        self.lower_budget(padded // 2)
+        tqdm.write(f"A batch of {padded} padded tokens failed to allocate, "
+                   f"the batch budget is now {self.max_batch_tokens} tokens")
+        middle = len(rows) // 2
+        return self.run_adaptive(run, rows[:middle], offset) + self.run_adaptive(run, rows[middle:], offset)
+
+    # Check that the restricted LM head gives the full-vocabulary scores of a batch.
+    def verify(self, sequences: list):
+        full = self.run_adaptive(lambda rows: self.forward(rows, mode="full"), sequences)
+        restricted = self.run_adaptive(lambda rows: self.forward(rows, mode="restricted"), sequences)
+
+        deviation = max(abs(normalize(*a)[0] - normalize(*b)[0]) for a, b in zip(full, restricted))
+        if deviation > self.tolerance:
+            raise ValueError(f"Restricted LM head deviates from the full-vocabulary scores by {deviation:.2e} "
+                             f"(tolerance {self.tolerance:.0e})")
+        self.verified = True
+
+    # Normalized (yes, no) probabilities of pre-tokenized sequences, in input order.
+    # Sequences sharing a prefix in the prefix cache are scored as suffixes of its past_key_values, the others in
+    # length-bucketed batches. on_scores(indices, scores) and on_log_probs(indices, log_probs) are called after
+    # every batch.
+    def score_ids(self, sequences: list, desc: str = "Dialogue ratings progress", on_scores=None, on_log_probs=None):
+        scores = [None] * len(sequences)
+        if not sequences:
+            return scores
+
+        if not self.verified:
+            # The shortest batch is the cheapest to score twice.
+            shortest = list(self.batches([len(sequence) for sequence in sequences]))[-1]
+            self.verify([sequences[index] for index in shortest])
+
+        if self.prefix_cache is not None:
+            groups, rest = self.prefix_cache.group(sequences)
+        else:
+            groups, rest = [], list(range(len(sequences)))
+
+        with tqdm(total=len(sequences), desc=desc, disable=not self.progress) as progress:
+            for node, indices in groups:
+                prefix = sequences[indices[0]][:node.depth]
+                past = self.prefix_cache.past(node, lambda: self.prefix_past(prefix))
+                suffixes = [sequences[index][node.depth:] for index in indices]
+
+                for batch in self.batches([node.depth + len(suffix) for suffix in suffixes]):
+                    log_probs = self.run_adaptive(lambda rows: self.forward_suffixes(past, node.depth, rows),
+                                                  [suffixes[position] for position in batch], node.depth)
+                    for position, (yes_log_prob, no_log_prob) in zip(batch, log_probs):
+                        scores[indices[position]] = normalize(yes_log_prob, no_log_prob)
+                    if on_log_probs is not None:
+                        on_log_probs([indices[position] for position in batch], log_probs)
+                    self._report([indices[position] for position in batch], scores, on_scores)
+                    progress.update(len(batch))
+
+            lengths = [len(sequences[index]) for index in rest]
+            if self.packing:
+                batches, forward = self.packs(lengths), self.forward_packed
+                if batches and not self.packing_verified:
+                    # The smallest pack is the cheapest to score twice.
+                    self.verify_packing([sequences[rest[position]] for position in batches[-1]])
+            else:
+                batches, forward = self.batches(lengths), self.forward
+
+            for batch in batches:
+                log_probs = self.run_adaptive(forward, [sequences[rest[position]] for position in batch])
+                for position, (yes_log_prob, no_log_prob) in zip(batch, log_probs):
+                    scores[rest[position]] = normalize(yes_log_prob, no_log_prob)
+                if on_log_probs is not None:
+                    on_log_probs([rest[position] for position in batch], log_probs)
+                self._report([rest[position] for position in batch], scores, on_scores)
+                progress.update(len(batch))
+
+        return scores
+
+    # Pass the scores of a finished batch to the on_scores callback.
+    @staticmethod
+    def _report(indices: list, scores: list, on_scores):
+        if on_scores is not None:
+            on_scores(indices, [scores[index] for index in indices])
+
+    # Normalized (yes, no) probabilities of the prompts, in input order.
+    # With a score cache, the log-probabilities of prompts already scored by the same model and mode are read from
+    # it, and only the other prompts are tokenized and batched. sequences are the token ids of the prompts when they
+    # are already tokenized.
+    def score(self, prompts: list, desc: str = "Dialogue ratings progress", on_scores=None, sequences: list = None):
+        if self.score_cache is None or not self.deterministic:
+            sequences = sequences if sequences is not None else self.tokenize(prompts)
+            self.forwarded += len(sequences)
+            return self.score_ids(sequences, desc=desc, on_scores=on_scores)
+
+        keys = [cache_key(self.cache_namespace, prompt) for prompt in prompts]
+        cached = self.score_cache.get_many(keys)
+
+        scores = [None] * len(prompts)
+        hits = [index for index, key in enumerate(keys) if key in cached]
+        for index in hits:
+            scores[index] = normalize(*cached[keys[index]])
+        if hits:
+            self._report(hits, scores, on_scores)
+
+        missing = [index for index, key in enumerate(keys) if key not in cached]
+
+        # Store the log-probabilities of a batch and report its scores, with indices in the prompts.
+        def on_missing_log_probs(indices, log_probs):
+            self.score_cache.put_many([(keys[missing[index]], log_prob) for index, log_prob in zip(indices, log_probs)])
+
+        def on_missing_scores(indices, batch_scores):
+            if on_scores is not None:
+                on_scores([missing[index] for index in indices], batch_scores)
+
+        if sequences is not None:
+            missing_sequences = [sequences[index] for index in missing]
+        else:
+            missing_sequences = self.tokenize([prompts[index] for index in missing])
+        self.forwarded += len(missing_sequences)
+        missing_scores = self.score_ids(missing_sequences, desc=desc, on_scores=on_missing_scores,
+                                        on_log_probs=on_missing_log_probs)
+        for index, score in zip(missing, missing_scores):
+            scores[index] = score
+        return scores
+
+    # Release the resources of the engine (nothing to release in a single process).
+    def close(self):
+        pass
+
+    # Scores read from logits, without sampling, are the same on every run unless dropout is active.
+    @property
+    def deterministic(self):
+        return not self.model.training
+
+    # Scores of repeated runs over the same prompts, one list per run (None for the prompts not scored).
+    # pending lists, per run, the indices of the prompts to score (all of them by default). A deterministic engine
+    # scores every prompt pending in any run once and gives the same scores to every run.
+    # on_scores(run, indices, scores) is called after every batch of every run. sequences are the token ids of the
+    # prompts when they are already tokenized.
+    def score_runs(self, prompts: list, runs: int, desc: str = "Dialogue ratings progress", on_scores=None,
+                   pending: list = None, sequences: list = None):
+        pending = [set(indices) for indices in pending] if pending is not None else [set(range(len(prompts)))] * runs
+        scores = [[None] * len(prompts) for _ in range(runs)]
+
+        if self.deterministic:
+            work = [(list(range(runs)), sorted(set().union(*pending)), desc)]
+        else:
+            work = [([run], sorted(pending[run]), f"{desc} (run {run + 1}/{runs})") for run in range(runs)]
+
+        for work_runs, indices, work_desc in work:
+            # Scores of a batch for the runs where its prompts are pending.
+            def on_batch(batch, batch_scores):
+                for run in work_runs:
+                    kept = [(indices[position], score) for position, score in zip(batch, batch_scores)
+                            if indices[position] in pending[run]]
+                    for index, score in kept:
+                        scores[run][index] = score
+                    if on_scores is not None and kept:
+                        on_scores(run, [index for index, _ in kept], [score for _, score in kept])
+
+            if indices:
+                self.score([prompts[index] for index in indices], desc=work_desc, on_scores=on_batch,
+                           sequences=[sequences[index] for index in indices] if sequences is not None else None)
+        return scores
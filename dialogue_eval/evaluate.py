@@ -0,0 +1,555 @@
+import collections
+import json
+import os
+import time
+
+from dialogue_eval.batch_budget import DEFAULT_PATH as BATCH_BUDGETS_PATH, BatchBudgets
+from dialogue_eval.checkpoints import DEFAULT_DIR as CHECKPOINT_DIR, is_converted, load_converted
+from dialogue_eval.datasets import DATASETS, LEVELS, examples
+from dialogue_eval.engine import InferenceEngine
+from dialogue_eval.journal import ResultJournal, read_journal, write_json_atomic
+from dialogue_eval.metrics import metric_drift
+from dialogue_eval.models import DTYPES, ROOT, file_prefix, load_model, load_tokenizer, model_spec, results_dir
+from dialogue_eval.parallel import WorkerPoolEngine
+from dialogue_eval.pipeline import BackgroundWriter, Prefetcher, StageTimer
+from dialogue_eval.quantization import DEFAULT_DIR as QUANTIZED_DIR, QUANTIZATIONS, load_quantized
+from dialogue_eval.prompts import DIALOGUE, RENDERERS, TURN, dialogue_fields, prompt_version, turn_fields
+from dialogue_eval.score_cache import DEFAULT_PATH, ScoreCache
+from dialogue_eval.streaming import LayerStreamingEngine
+from dialogue_eval.token_cache import DEFAULT_DIR, TokenCache
+from dialogue_eval.topology import configure_threads, numa_nodes
+from dialogue_eval.truncation import TruncationPolicy, truncate_examples
+
+
+# Template of the prompts at a level.
+def prompt_template(level: str):
+    return TURN if level == "turn" else DIALOGUE
+
+
+# Field values of the prompt of an example at a level, with the turns laid out by a renderer.
+def prompt_fields(example, level: str, renderer: str = "list"):
+    if level == "turn":
+        return turn_fields(example.context, example.response, example.turn_speakers(), renderer)
+    return dialogue_fields(example.turns(), example.turn_speakers(), renderer)
+
+
+# Prompt of an example at a level.
+def render_prompt(example, level: str, renderer: str = "list"):
+    return prompt_template(level).render(**prompt_fields(example, level, renderer))
+
+
+# Examples of a dataset at a level, truncated to the caps of a truncation policy for a tokenizer, and the
+# truncation stats (None without truncation).
+def dataset_examples(dataset: str, level: str, root: str = ROOT, renderer: str = "list", tokenizer=None,
+                     truncation: TruncationPolicy = None):
+    records = examples(dataset, level, os.path.join(root, "_datasets"))
+    if not truncation:
+        return records, None
+    return truncate_examples(records, tokenizer, truncation, lambda example: render_prompt(example, level, renderer))
+
+
+# Field values of the prompts of a dataset at a level (or of the given examples of it).
+def build_prompt_fields(dataset: str, level: str, root: str = ROOT, renderer: str = "list", records: list = None):
+    if records is None:
+        records = examples(dataset, level, os.path.join(root, "_datasets"))
+    return [prompt_fields(example, level, renderer) for example in records]
+
+
+# Prompts of a dataset at a level (or of the given examples of it): (id_dialogue, prompt).
+def build_prompts(dataset: str, level: str, root: str = ROOT, renderer: str = "list", records: list = None):
+    if records is None:
+        records = examples(dataset, level, os.path.join(root, "_datasets"))
+    prompts = []
+    for example in records:
+        prompts.append((example.id_dialogue, render_prompt(example, level, renderer)))
+    return prompts
+
+
+# Process the desired output.
+def process_list(dialogue_id: int, yes: float, no: float):
+    return {
+        "id_dialogue": dialogue_id,
+        "yes": yes,
+        "no": no
+    }
+
+
+# Save the ratings in the {"dialogues": [...]} layout read by the metrics scripts.
+def write_ratings(file_path: str, dialogue_ids: list, scores: list):
+    formatted_dialogues = [process_list(dialogue_id, yes, no) for dialogue_id, (yes, no) in zip(dialogue_ids, scores)]
+    write_json_atomic(file_path, {"dialogues": formatted_dialogues})
+
+
+# Unique id of every example: its id_dialogue and the number of earlier examples with the same id
+# (the USR datasets have one example per response of a dialogue).
+def example_uids(dialogue_ids: list):
+    seen = collections.Counter()
+    uids = []
+    for dialogue_id in dialogue_ids:
+        uids.append(f"{dialogue_id}:{seen[dialogue_id]}")
+        seen[dialogue_id] += 1
+    return uids
+
+
+# Key of the journal records of a run, so that partial runs of different configurations never mix.
+# Records written before truncation, dtypes and quantization existed have no "truncation", "dtype" and
+# "quantization" fields, which matches untruncated fp32 runs.
+def record_key(model_name: str, dataset: str, level: str, run: int = 0, renderer: str = "list",
+               truncation: TruncationPolicy = None, dtype: str = "fp32", quantization: str = None):
+    return {"model": model_spec(model_name)["checkpoint"], "dataset": dataset, "level": level,
+            "prompt": prompt_version(renderer), "run": run,
+            "truncation": truncation.describe() if truncation else None,
+            "dtype": dtype if dtype != "fp32" else None, "quantization": quantization}
+
+
+# Journal records with the given key, the last one of every example, in prompt order.
+def keyed_records(records: list, key: dict):
+    latest = {}
+    for record in records:
+        if all(record.get(field) == value for field, value in key.items()):
+            latest[record["uid"]] = record
+    return sorted(latest.values(), key=lambda record: record["index"])
+
+
+# Ratings of the journal records with the given key, in prompt order.
+def journal_ratings(records: list, key: dict):
+    records = keyed_records(records, key)
+    return [record["id_dialogue"] for record in records], [(record["yes"], record["no"]) for record in records]
+
+
+# Save the mean of the ratings of several runs.
+def write_mean_ratings(file_paths: list, output_path: str):
+    aggregated_data = {}
+
+    for file_path in file_paths:
+        with open(file_path, 'r') as json_file:
+            data = json.load(json_file)
+            dialogues = data.get("dialogues", [])
+            for dialogue in dialogues:
+                dialogue_id = dialogue["id_dialogue"]
+                if dialogue_id not in aggregated_data:
+                    aggregated_data[dialogue_id] = {"yes": 0, "no": 0}
+                aggregated_data[dialogue_id]["yes"] += dialogue["yes"]
+                aggregated_data[dialogue_id]["no"] += dialogue["no"]
+
+    # Compute mean of dialogues.
+    mean_dialogues = []
+    for dialogue_id, values in aggregated_data.items():
+        mean_dialogues.append({
+            "id_dialogue": dialogue_id,
+            "mean_yes": values["yes"] / len(file_paths),
+            "mean_no": values["no"] / len(file_paths)
+        })
+
+    write_json_atomic(output_path, {"dialogues": mean_dialogues})
+
+
+# Save the metadata of a run: its configuration and the truncation stats of its prompts.
+def write_run_metadata(file_path: str, model_name: str, dataset: str, level: str, renderer: str,
+                       truncation: TruncationPolicy, truncation_stats: dict, examples_count: int,
+                       dtype: str = "fp32", quantization: str = None):
+    write_json_atomic(file_path, {
+        "model": model_name,
+        "checkpoint": model_spec(model_name)["checkpoint"],
+        "dataset": dataset,
+        "level": level,
+        "dtype": dtype,
+        "quantization": quantization,
+        "prompt": prompt_version(renderer),
+        "renderer": renderer,
+        "examples": examples_count,
+        "truncation": truncation.describe() if truncation else None,
+        "truncation_stats": truncation_stats,
+    })
+
+
+# Prepare the scoring of a dataset at a level, without the model: load the journal of earlier runs (the examples
+# already in it for the same model, dataset, level, prompt version and run are skipped with resume), render the
+# prompts of the examples (see dataset_examples) and, when examples are left to score, read their token ids from the
+# token cache. Without a token cache, the pending prompts are tokenized by dataset_chunks.
+def prepare_dataset(tokenizer, model_name: str, dataset: str, level: str, root: str = ROOT, resume: bool = True,
+                    token_cache: TokenCache = None, renderer: str = "list", truncation: TruncationPolicy = None,
+                    dtype: str = "fp32", quantization: str = None, timer: StageTimer = None):
+    timer = timer or StageTimer()
+    directory = results_dir(model_name, dataset, level, root)
+    prefix = file_prefix(model_name, dataset, renderer, truncation, dtype, quantization)
+    journal_path = os.path.join(directory, f"{prefix}_dialogue_ratings.jsonl")
+    runs = DATASETS[dataset].get("runs")
+    keys = [record_key(model_name, dataset, level, run, renderer, truncation, dtype, quantization)
+            for run in range(runs or 1)]
+
+    with timer.stage("load"):
+        if not resume and os.path.exists(journal_path):
+            os.remove(journal_path)
+        journal = read_journal(journal_path)
+
+    with timer.stage("render"):
+        records, truncation_stats = dataset_examples(dataset, level, root, renderer, tokenizer, truncation)
+        prompts = build_prompts(dataset, level, root, renderer, records)
+        uids = example_uids([dialog_id for dialog_id, _ in prompts])
+        done = [{record["uid"] for record in keyed_records(journal, key)} for key in keys]
+        pending = [[index for index, uid in enumerate(uids) if uid not in done[run]] for run in range(len(keys))]
+
+    sequences = None
+    with timer.stage("tokenize"):
+        if any(pending) and token_cache is not None:
+            sequences = token_cache.sequences(tokenizer, dataset, level, [prompt for _, prompt in prompts],
+                                              prompt_template(level),
+                                              build_prompt_fields(dataset, level, root, renderer, records))
+
+    return {
+        "model_name": model_name, "dataset": dataset, "level": level, "renderer": renderer, "truncation": truncation,
+        "dtype": dtype, "quantization": quantization, "truncation_stats": truncation_stats, "directory": directory,
+        "prefix": prefix, "journal_path": journal_path, "runs": runs, "keys": keys, "records": records,
+        "prompts": prompts, "uids": uids, "pending": pending, "sequences": sequences,
+    }
+
+
+# Chunks of the examples of a prepared dataset pending in any run, in dataset order: (indices, token ids) of up to
+# chunk_size examples. Only the pending examples are tokenized, a chunk at a time, when there is no token cache.
+def dataset_chunks(tokenizer, prepared: dict, chunk_size: int = 256, timer: StageTimer = None):
+    timer = timer or StageTimer()
+    records, level, renderer = prepared["records"], prepared["level"], prepared["renderer"]
+    indices = sorted(set().union(*prepared["pending"]))
+    for start in range(0, len(indices), chunk_size):
+        chunk = indices[start:start + chunk_size]
+        with timer.stage("tokenize"):
+            if prepared["sequences"] is not None:
+                sequences = [prepared["sequences"][index] for index in chunk]
+            else:
+                values = [prompt_fields(records[index], level, renderer) for index in chunk]
+                sequences = prompt_template(level).token_ids(tokenizer, values)
+        yield chunk, sequences
+
+
+# Write the ratings JSON files of a scored dataset from its journal.
+def write_dataset_ratings(prepared: dict):
+    directory, prefix, keys, runs = prepared["directory"], prepared["prefix"], prepared["keys"], prepared["runs"]
+    records = read_journal(prepared["journal_path"])
+
+    if runs is None:
+        write_ratings(os.path.join(directory, f"{prefix}_dialogue_ratings.json"), *journal_ratings(records, keys[0]))
+        return
+
+    file_paths = [os.path.join(directory, "test", f"{prefix}_dialogue_ratings{run + 1}.json") for run in range(runs)]
+    for key, file_path in zip(keys, file_paths):
+        write_ratings(file_path, *journal_ratings(records, key))
+    write_mean_ratings(file_paths, os.path.join(directory, f"{prefix}_dialogue_ratings_mean.json"))
+
+
+# Score a prepared dataset, a chunk at a time (see dataset_chunks; chunks are made here when none are given). Every
+# scored example is appended to a JSONL journal as its batch finishes; the ratings JSON files are written once from
+# the journal at the end. With a writer, the journal records and the files are written by its background thread,
+# and this returns as soon as the forward passes are done.
+def score_dataset(engine: InferenceEngine, prepared: dict, flush_every: int = 64, writer: BackgroundWriter = None,
+                  timer: StageTimer = None, chunks=None):
+    timer = timer or StageTimer()
+    if chunks is None:
+        chunks = dataset_chunks(engine.tokenizer, prepared, timer=timer)
+    model_name, dataset, level = prepared["model_name"], prepared["dataset"], prepared["level"]
+    prompts, uids, keys = prepared["prompts"], prepared["uids"], prepared["keys"]
+    truncation_stats = prepared["truncation_stats"]
+    desc = f"{model_name} {dataset} {level}-level ratings"
+
+    # Run the write tasks on the writer thread, in order, or right away.
+    def write(function, *args):
+        if writer is not None:
+            writer.submit(function, *args)
+        else:
+            with timer.stage("write"):
+                function(*args)
+
+    if truncation_stats is not None:
+        print(f"{dataset} {level}-level: {truncation_stats['truncated_examples']}/{truncation_stats['examples']} "
+              f"prompts truncated, {truncation_stats['tokens_before']} -> {truncation_stats['tokens_after']} tokens")
+    write(write_run_metadata, os.path.join(prepared["directory"], f"{prepared['prefix']}_dialogue_run.json"),
+          model_name, dataset, level, prepared["renderer"], prepared["truncation"], truncation_stats, len(prompts),
+          prepared["dtype"], prepared["quantization"])
+
+    journal = ResultJournal(prepared["journal_path"], flush_every)
+    pending = [set(indices) for indices in prepared["pending"]]
+    total = len(set().union(*pending))
+
+    # Write one record per example and run.
+    def on_scores(run, indices, scores):
+        for index, (yes, no) in zip(indices, scores):
+            write(journal.write, {**keys[run], "uid": uids[index], "index": index, "id_dialogue": prompts[index][0],
+                                  "yes": yes, "no": no})
+
+    try:
+        scored = 0
+        for chunk, sequences in chunks:
+            # Positions in the chunk of the examples pending in every run.
+            chunk_pending = [[position for position, index in enumerate(chunk) if index in indices]
+                             for indices in pending]
+
+            def on_chunk_scores(run, positions, scores, chunk=chunk):
+                on_scores(run, [chunk[position] for position in positions], scores)
+
+            with timer.stage("forward"):
+                engine.score_runs([prompts[index][1] for index in chunk], len(keys),
+                                  desc=f"{desc} ({scored + len(chunk)}/{total})", on_scores=on_chunk_scores,
+                                  pending=chunk_pending, sequences=sequences)
+            scored += len(chunk)
+    finally:
+        write(journal.close)
+    write(write_dataset_ratings, prepared)
+
+
+def _check_names(model_name: str, datasets: list, levels: list, renderer: str = "list"):
+    model_spec(model_name)
+    if renderer not in RENDERERS:
+        raise ValueError(f"Unknown renderer '{renderer}', expected one of {RENDERERS}")
+    for dataset in datasets:
+        if dataset not in DATASETS:
+            raise ValueError(f"Unknown dataset '{dataset}', expected one of {sorted(DATASETS)}")
+    for level in levels:
+        if level not in LEVELS:
+            raise ValueError(f"Unknown level '{level}', expected one of {LEVELS}")
+
+
+# Tokenize the prompts of every requested dataset and level with the tokenizer of a model, into the token cache.
+def build_token_cache(model_name: str, datasets: list = tuple(DATASETS), levels: list = LEVELS, root: str = ROOT,
+                      token_cache_dir: str = DEFAULT_DIR, renderer: str = "list", truncation: TruncationPolicy = None):
+    _check_names(model_name, datasets, levels, renderer)
+
+    tokenizer = load_tokenizer(model_name)
+    token_cache = TokenCache(token_cache_dir)
+    for dataset in datasets:
+        for level in levels:
+            if level in DATASETS[dataset]["levels"]:
+                records, _ = dataset_examples(dataset, level, root, renderer, tokenizer, truncation)
+                prompts = [prompt for _, prompt in build_prompts(dataset, level, root, renderer, records)]
+                sequences = token_cache.sequences(tokenizer, dataset, level, prompts, prompt_template(level),
+                                                  build_prompt_fields(dataset, level, root, renderer, records))
+                print(f"{dataset} {level}-level: {len(sequences)} prompts, {sum(len(s) for s in sequences)} tokens")
+
+
+# Model resident in memory across evaluation jobs: the tokenizer and the model are loaded once, with the engine
+# scoring them, and every queued job (a dataset at a level, with a renderer and a truncation policy) reuses them.
+# Scores are kept in the score cache at score_cache_path, unless score_cache_bytes is 0, and the token ids of
+# the prompts in token_cache_dir, unless it is None. With several workers, the model is shared by worker processes
+# forked from this one; with numa, every NUMA node runs its own replica on its CPUs (and this process drops its
+# copy of the weights). threads and interop_threads set the torch threads of a single process. The batch token
+# budget learned from allocation failures is kept in batch_budgets_path, unless it is None. The model is loaded
+# from its converted checkpoint in checkpoint_dir when there is one (see convert_model), unless checkpoint_dir is
+# None, with its weights in dtype. Its linear layers are quantized (see load_quantized) with the quantization of the
+# model in the registry, or another one ("none" for none), and the quantized weights are cached in quantized_dir.
+class EvaluationSession:
+
+    def __init__(self, model_name: str, root: str = ROOT, score_cache_path: str = DEFAULT_PATH,
+                 score_cache_bytes: int = 1024 ** 3, token_cache_dir: str = DEFAULT_DIR, workers: int = 1,
+                 threads_per_worker: int = None, numa: bool = False, threads: int = None,
+                 interop_threads: int = None, batch_budgets_path: str = BATCH_BUDGETS_PATH,
+                 checkpoint_dir: str = CHECKPOINT_DIR, dtype: str = "fp32", quantization: str = None,
+                 quantized_dir: str = QUANTIZED_DIR, stream_layers: int = None, stream_tokens: int = 65536,
+                 **engine_kwargs):
+        spec = model_spec(model_name)
+        if workers < 1:
+            raise ValueError("workers must be positive")
+        if dtype not in DTYPES:
+            raise ValueError(f"Unknown dtype '{dtype}', expected one of {list(DTYPES)}")
+        if quantization is None:
+            quantization = spec.get("quantization")
+        elif quantization == "none":
+            quantization = None
+        if quantization is not None and quantization not in QUANTIZATIONS:
+            raise ValueError(f"Unknown quantization '{quantization}', expected one of {QUANTIZATIONS}")
+        if stream_layers is not None:
+            if workers > 1 or numa or quantization is not None:
+                raise ValueError("Layer streaming runs a single process on the unquantized weights")
+            if checkpoint_dir is None or not is_converted(model_name, dtype, checkpoint_dir):
+                raise ValueError(f"Layer streaming needs a converted checkpoint: python -m dialogue_eval convert "
+                                 f"--model {model_name} --dtype {dtype}")
+        self.model_name = model_name
+        self.dtype = dtype
+        self.quantization = quantization
+        self.root = root
+        self.jobs = []
+        self.token_cache = TokenCache(token_cache_dir) if token_cache_dir is not None else None
+        self.score_cache = ScoreCache(score_cache_path, score_cache_bytes) if score_cache_bytes > 0 else None
+        if batch_budgets_path is not None:
+            engine_kwargs["batch_budgets"] = BatchBudgets(batch_budgets_path)
+
+        # Before loading the model, whose loading may start the inter-op threads of torch.
+        if not numa and workers == 1:
+            configure_threads(threads, interop_threads)
+
+        start = time.perf_counter()
+        self.converted = checkpoint_dir is not None and is_converted(model_name, dtype, checkpoint_dir)
+        if self.converted:
+            self.tokenizer, model = load_converted(model_name, dtype, root, checkpoint_dir)
+        else:
+            self.tokenizer, model = load_model(model_name, root, dtype)
+        if quantization is not None:
+            model = load_quantized(model, model_name, quantization, dtype, quantized_dir)
+        if numa:
+            nodes = numa_nodes()
+            self.engine = WorkerPoolEngine(model, self.tokenizer, cpu_sets=list(nodes.values()),
+                                           replicated=len(nodes) > 1, release_weights=True,
+                                           score_cache=self.score_cache, **engine_kwargs)
+        elif workers > 1:
+            self.engine = WorkerPoolEngine(model, self.tokenizer, workers, threads_per_worker,
+                                           score_cache=self.score_cache, **engine_kwargs)
+        elif stream_layers is not None:
+            self.engine = LayerStreamingEngine(model, self.tokenizer, stream_layers, stream_tokens,
+                                               score_cache=self.score_cache, **engine_kwargs)
+        else:
+            self.engine = InferenceEngine(model, self.tokenizer, score_cache=self.score_cache, **engine_kwargs)
+        self.load_seconds = time.perf_counter() - start
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    # Queue the scoring of a dataset at a level.
+    def submit(self, dataset: str, level: str, renderer: str = "list", truncation: TruncationPolicy = None):
+        _check_names(self.model_name, [dataset], [level], renderer)
+        if level not in DATASETS[dataset]["levels"]:
+            raise ValueError(f"Dataset '{dataset}' has no {level}-level annotations")
+        self.jobs.append((dataset, level, renderer, truncation))
+
+    # Run the queued jobs in order and empty the queue. Returns the run report: the load time of the model, the
+    # time of every job (preparing its prompts and scoring them), the ratings it wrote over all its runs and the
+    # prompts the model actually scored for them (deterministic runs share their forward passes, and cached scores
+    # need none), and the time of every stage of the pipeline.
+    # A producer thread prepares the jobs and tokenizes their pending prompts in chunks of chunk_size, up to prefetch
+    # chunks ahead of the model, which starts on the first chunk of a job while the next ones are tokenized; a writer
+    # thread writes the results behind it.
+    def run(self, flush_every: int = 64, resume: bool = True, prefetch: int = 1, chunk_size: int = 256):
+        if prefetch < 1 or chunk_size < 1:
+            raise ValueError("prefetch and chunk_size must be positive")
+        jobs, self.jobs = self.jobs, []
+        timer = StageTimer()
+        reports = []
+
+        # Items of every job, in order: its prepared dataset, its chunks, and None.
+        def produce():
+            for dataset, level, renderer, truncation in jobs:
+                start = time.perf_counter()
+                prepared = prepare_dataset(self.tokenizer, self.model_name, dataset, level, self.root, resume,
+                                           self.token_cache, renderer, truncation, self.dtype, self.quantization,
+                                           timer=timer)
+                prepared["prepare_seconds"] = time.perf_counter() - start
+                yield prepared
+                chunks = dataset_chunks(self.tokenizer, prepared, chunk_size, timer)
+                while True:
+                    start = time.perf_counter()
+                    chunk = next(chunks, None)
+                    prepared["prepare_seconds"] += time.perf_counter() - start
+                    yield chunk
+                    if chunk is None:
+                        break
+
+        prefetcher = Prefetcher(produce(), depth=prefetch, timer=timer)
+        writer = BackgroundWriter(timer=timer)
+        try:
+            items = iter(prefetcher)
+            for prepared in items:
+                start = time.perf_counter()
+                forwarded = self.engine.forwarded
+                forward_seconds = timer.report()["stages"].get("forward", 0.0)
+                score_dataset(self.engine, prepared, flush_every, writer, timer, iter(items.__next__, None))
+                seconds = time.perf_counter() - start
+                score_seconds = timer.report()["stages"].get("forward", 0.0) - forward_seconds
+                truncation = prepared["truncation"]
+                reports.append({
+                    "dataset": prepared["dataset"], "level": prepared["level"], "renderer": prepared["renderer"],
+                    "truncation": truncation.describe() if truncation else None,
+                    "examples": len(prepared["prompts"]), "runs": len(prepared["keys"]),
+                    "ratings": sum(len(pending) for pending in prepared["pending"]),
+                    "forwarded": self.engine.forwarded - forwarded,
+                    "prepare_seconds": prepared["prepare_seconds"], "score_seconds": score_seconds,
+                    "seconds": seconds,
+                })
+        finally:
+            prefetcher.close()
+            writer.close()
+
+        stages = timer.report()
+        return {"model": self.model_name, "checkpoint": model_spec(self.model_name)["checkpoint"], "dtype": self.dtype,
+                "quantization": self.quantization,
+                "converted": self.converted, "load_seconds": self.load_seconds, "jobs": reports, "wall": stages["wall"],
+                "stages": stages["stages"], "bottleneck": stages["bottleneck"]}
+
+    def close(self):
+        self.engine.close()
+        if self.score_cache is not None:
+            self.score_cache.close()
+
+
+# Print a run report of a session.
+def print_run_report(report: dict):
+    source = "converted checkpoint" if report["converted"] else report["checkpoint"]
+    weights = report["dtype"] + (f", {report['quantization']}" if report["quantization"] else "")
+    print(f"Model load: {report['load_seconds']:.2f} s ({report['model']} in {weights}, {source})")
+    for job in report["jobs"]:
+        print(f"{job['dataset']} {job['level']}-level ({job['renderer']}): {job['seconds']:.2f} s "
+              f"(prepare {job['prepare_seconds']:.2f} s, score {job['score_seconds']:.2f} s), "
+              f"{job['forwarded']} prompts forwarded for {job['ratings']} ratings"
+              + (f" ({job['examples']} examples x {job['runs']} runs)" if job["runs"] > 1 else ""))
+    for stage, seconds in sorted(report["stages"].items(), key=lambda item: -item[1]):
+        print(f"{stage}: {seconds:.2f} s ({seconds / report['wall']:.0%} of {report['wall']:.2f} s)")
+    print(f"Bottleneck: {report['bottleneck']}")
+
+
+# Accuracy guardrail of a run with reduced-precision or quantized weights: the correlations of the ratings of every
+# job of its report must stay within max_drift of the fp32 ones saved in the *_dialogue_metrics.json files (jobs
+# without them are reported and not checked). Adds the drift of every job to the report; raises a RuntimeError
+# when a correlation moved further.
+def check_drift(report: dict, root: str = ROOT, renderer: str = "list", truncation: TruncationPolicy = None,
+                max_drift: float = 0.02):
+    weights = report["dtype"] + (f" {report['quantization']}" if report["quantization"] else "")
+    failed = []
+    for job in report["jobs"]:
+        drift = metric_drift(report["model"], job["dataset"], job["level"], root, renderer, truncation,
+                             report["dtype"], report["quantization"])
+        job["drift"] = drift
+        name = f"{job['dataset']} {job['level']}-level"
+        if drift is None:
+            print(f"{name}: no fp32 metrics to compare the {weights} ratings with")
+            continue
+        print(f"{name} {weights} drift from fp32: "
+              + ", ".join(f"{metric} {value:+.4f}" for metric, value in drift.items()))
+        # A NaN correlation (constant ratings) fails too.
+        if not all(abs(value) <= max_drift for value in drift.values()):
+            failed.append(name)
+    if failed:
+        raise RuntimeError(f"The {weights} correlations of {', '.join(failed)} drift more than {max_drift} from fp32")
+
+
+# Load a model once and evaluate it on every requested dataset and level it supports, in one session. With a
+# truncation policy, the prompts are truncated to its token caps. With a dtype other than fp32 or quantized
+# weights, the correlations of the ratings are checked against the fp32 ones (see check_drift), unless max_drift
+# is None. The run report (load time, time of every dataset and of every stage) is printed, saved at report_path
+# when given, and returned.
+def evaluate(model_name: str, datasets: list = tuple(DATASETS), levels: list = LEVELS, root: str = ROOT,
+             flush_every: int = 64, resume: bool = True, score_cache_path: str = DEFAULT_PATH,
+             score_cache_bytes: int = 1024 ** 3, token_cache_dir: str = DEFAULT_DIR, renderer: str = "list",
+             truncation: TruncationPolicy = None, workers: int = 1, threads_per_worker: int = None,
+             numa: bool = False, threads: int = None, interop_threads: int = None,
+             batch_budgets_path: str = BATCH_BUDGETS_PATH, prefetch: int = 1, chunk_size: int = 256,
+             report_path: str = None, checkpoint_dir: str = CHECKPOINT_DIR, dtype: str = "fp32",
+             max_drift: float = 0.02, quantization: str = None, quantized_dir: str = QUANTIZED_DIR,
+             stream_layers: int = None, stream_tokens: int = 65536, **engine_kwargs):
+    _check_names(model_name, datasets, levels, renderer)
+
+    with EvaluationSession(model_name, root, score_cache_path, score_cache_bytes, token_cache_dir, workers,
+                           threads_per_worker, numa, threads, interop_threads, batch_budgets_path, checkpoint_dir,
+                           dtype, quantization, quantized_dir, stream_layers, stream_tokens,
+                           **engine_kwargs) as session:
+        for dataset in datasets:
+            for level in levels:
+                if level in DATASETS[dataset]["levels"]:
+                    session.submit(dataset, level, renderer, truncation)
+        report = session.run(flush_every, resume, prefetch, chunk_size)
+    print_run_report(report)
+    try:
+        if (dtype != "fp32" or report["quantization"]) and max_drift is not None:
+            check_drift(report, root, renderer, truncation, max_drift)
+    finally:
+        if report_path is not None:
+            write_json_atomic(report_path, report)
+    return report
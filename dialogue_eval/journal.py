@@ -0,0 +1,81 @@
+import json
+import os
+
+
+# Write a JSON file atomically: readers see the old file or the complete new one, never a partial write.
+def write_json_atomic(file_path: str, data, indent: int = 4):
+    directory = os.path.dirname(file_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    tmp_path = f"{file_path}.tmp"
+    with open(tmp_path, 'w') as json_file:
+        json.dump(data, json_file, indent=indent)
+        json_file.flush()
+        os.fsync(json_file.fileno())
+    os.replace(tmp_path, file_path)
+
+
+# Records of a journal, in write order. A last line cut by an interrupted run is ignored.
+def read_journal(file_path: str):
+    if not os.path.exists(file_path):
+        return []
+
+    records = []
+    with open(file_path, 'r') as journal_file:
+        for line in journal_file:
+            if not line.endswith("\n"):
+                break
+            records.append(json.loads(line))
+    return records
+
+
+# Cut a last line left incomplete by an interrupted run, so that new records start on their own line.
+def _truncate_partial_line(file_path: str):
+    if not os.path.exists(file_path):
+        return
+
+    with open(file_path, 'rb+') as journal_file:
+        content = journal_file.read()
+        if content and not content.endswith(b"\n"):
+            journal_file.truncate(content.rfind(b"\n") + 1)
+
+
+# Append-only JSONL journal of the scored examples, one compact record per line.
+# Records are buffered and written flush_every at a time, so a run costs O(n) writes instead of rewriting the
+# whole ratings file after every example.
+class ResultJournal:
+
+    def __init__(self, file_path: str, flush_every: int = 64):
+        if flush_every < 1:
+            raise ValueError("flush_every must be positive")
+
+        os.makedirs(os.path.dirname(file_path) or ".", exist_ok=True)
+        _truncate_partial_line(file_path)
+        self.file_path = file_path
+        self.flush_every = flush_every
+        self.buffer = []
+        self.file = open(file_path, 'a')
+
+    def write(self, record: dict):
+        self.buffer.append(json.dumps(record, separators=(",", ":")) + "\n")
+        if len(self.buffer) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.file.writelines(self.buffer)
+            self.buffer = []
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        if not self.file.closed:
+            self.flush()
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
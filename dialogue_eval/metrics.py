@@ -0,0 +1,115 @@
+import json
+import os
+
+from scipy.stats import kendalltau, pearsonr, spearmanr
+
+from dialogue_eval.datasets import DATASETS, LEVELS, examples
+from dialogue_eval.journal import write_json_atomic
+from dialogue_eval.models import ROOT, file_prefix, model_spec, results_dir
+
+
+# Correlations between the human and predicted annotations.
+def correlations(human_annotations: list, predicted_annotations: list):
+    pearson_correlation, _ = pearsonr(human_annotations, predicted_annotations)
+    spearman_correlation, _ = spearmanr(human_annotations, predicted_annotations)
+    kendall_tau_correlation, _ = kendalltau(human_annotations, predicted_annotations)
+
+    return {
+        'pearson_correlation': pearson_correlation,
+        'spearman_correlation': spearman_correlation,
+        'kendall_tau_correlation': kendall_tau_correlation,
+    }
+
+
+# Human annotations of a dataset at a level, and the predicted ones of a ratings file.
+# field is the rating of the file compared with the human ones ('yes', or 'mean_yes' for averaged runs).
+def read_annotations(dataset: str, level: str, ratings_path: str, field: str, root: str = ROOT):
+    with open(ratings_path, 'r') as json_file:
+        ratings = json.load(json_file)
+
+    human_annotations = [example.score for example in examples(dataset, level, os.path.join(root, "_datasets"))]
+    predicted_annotations = [dialogue[field] for dialogue in ratings['dialogues']]
+    return human_annotations, predicted_annotations
+
+
+# Correlate the ratings of a file with the human ratings of a dataset, print and save them.
+def compute_metrics(dataset: str, level: str, ratings_path: str, output_path: str, field: str, root: str = ROOT):
+    # Annotations.
+    human_annotations, predicted_annotations = read_annotations(dataset, level, ratings_path, field, root)
+
+    # Metrics.
+    metrics = correlations(human_annotations, predicted_annotations)
+    for name, value in metrics.items():
+        print(f'{name}: {value}')
+
+    # Write metrics in JSON file.
+    dialogues = []
+    for i in range(len(human_annotations)):
+        dialogues.append({
+            'dialogue_id': i,
+            'human_annotation': human_annotations[i],
+            'predicted_annotation': predicted_annotations[i],
+        })
+
+    write_json_atomic(output_path, {"dialogues": dialogues, "metrics": metrics})
+    return metrics
+
+
+# Ratings file of a registered model for a dataset at a level, and the rating compared with the human ones.
+def ratings_file(model_name: str, dataset: str, level: str, root: str = ROOT, renderer: str = "list",
+                 truncation=None, dtype: str = "fp32", quantization: str = None):
+    directory = results_dir(model_name, dataset, level, root)
+    prefix = file_prefix(model_name, dataset, renderer, truncation, dtype, quantization)
+    if DATASETS[dataset].get("runs") is None:
+        return os.path.join(directory, f"{prefix}_dialogue_ratings.json"), 'yes'
+    return os.path.join(directory, f"{prefix}_dialogue_ratings_mean.json"), 'mean_yes'
+
+
+# Metrics of the ratings of a registered model for a dataset at a level.
+def model_metrics(model_name: str, dataset: str, level: str, root: str = ROOT, renderer: str = "list",
+                  truncation=None, dtype: str = "fp32", quantization: str = None):
+    directory = results_dir(model_name, dataset, level, root)
+    prefix = file_prefix(model_name, dataset, renderer, truncation, dtype, quantization)
+
+    ratings_path, field = ratings_file(model_name, dataset, level, root, renderer, truncation, dtype, quantization)
+    return compute_metrics(dataset, level, ratings_path, os.path.join(directory, f"{prefix}_dialogue_metrics.json"),
+                           field, root)
+
+
+# Metrics of a model on every requested dataset and level it supports.
+def metrics(model_name: str, datasets: list = tuple(DATASETS), levels: list = LEVELS, root: str = ROOT,
+            renderer: str = "list", truncation=None, dtype: str = "fp32", quantization: str = None):
+    model_spec(model_name)
+    results = {}
+    for dataset in datasets:
+        if dataset not in DATASETS:
+            raise ValueError(f"Unknown dataset '{dataset}', expected one of {sorted(DATASETS)}")
+        for level in levels:
+            if level in DATASETS[dataset]["levels"]:
+                print(f"{model_name} {dataset} {level}-level")
+                results[(dataset, level)] = model_metrics(model_name, dataset, level, root, renderer, truncation, dtype,
+                                                          quantization)
+    return results
+
+
+# Saved metrics of the fp32 ratings of a registered model for a dataset at a level, or None when there are none.
+def baseline_metrics(model_name: str, dataset: str, level: str, root: str = ROOT, renderer: str = "list",
+                     truncation=None):
+    prefix = file_prefix(model_name, dataset, renderer, truncation)
+    metrics_path = os.path.join(results_dir(model_name, dataset, level, root), f"{prefix}_dialogue_metrics.json")
+    if not os.path.exists(metrics_path):
+        return None
+    with open(metrics_path, 'r') as json_file:
+        return json.load(json_file)["metrics"]
+
+
+# Change of every correlation of the ratings of a model in a reduced-precision dtype or quantized from its fp32
+# baseline (the saved *_dialogue_metrics.json of the same prompts), or None without a baseline. The metrics of
+# the reduced-precision ratings are computed and saved.
+def metric_drift(model_name: str, dataset: str, level: str, root: str = ROOT, renderer: str = "list",
+                 truncation=None, dtype: str = "bf16", quantization: str = None):
+    baseline = baseline_metrics(model_name, dataset, level, root, renderer, truncation)
+    if baseline is None:
+        return None
+    reduced = model_metrics(model_name, dataset, level, root, renderer, truncation, dtype, quantization)
+    return {name: reduced[name] - baseline[name] for name in baseline}
@@ -0,0 +1,146 @@
+import importlib
+import os
+import sys
+
+
+# Local LLM evaluators: checkpoint, loading arguments and where their results are saved
+# (<directory>/<dataset>_data/<level>_level/<prefix>_dialogue_ratings.json). A "quantization" ("int8" or "int4",
+# see dialogue_eval.quantization) scores a model with quantized linear layers by default.
+MODELS = {
+    "baichuan2-13b": {
+        "checkpoint": "baichuan-inc/Baichuan2-13B-Chat",
+        "auto_class": "AutoModelForCausalLM",
+        "kwargs": {"trust_remote_code": True},
+        "directory": "Baichuan2-13B",
+        "prefix": "baichuan2-13b-chat",
+    },
+    "chatglm3-6b": {
+        "checkpoint": "THUDM/chatglm3-6b-base",
+        "auto_class": "AutoModel",
+        "kwargs": {"trust_remote_code": True},
+        # Using transformers==4.40.0
+        # Execute this command in terminal:
+        # pip install transformers==4.40.0 --target=.venv/transformers_v40
+        "transformers_path": ".venv/transformers_v40",
+        "directory": "Chatglm3-6B",
+        "prefix": "chatglm3-6b",
+    },
+    "chimera-13b": {
+        "checkpoint": "Yhyu13/chimera-inst-chat-13b-hf",
+        "auto_class": "AutoModelForCausalLM",
+        "kwargs": {},
+        "directory": "Chimera13B",
+        "prefix": "chimera-inst-chat-13b",
+    },
+    "llama2-13b": {
+        "checkpoint": "meta-llama/Llama-2-13b-chat-hf",
+        "auto_class": "AutoModelForCausalLM",
+        "kwargs": {"trust_remote_code": True, "use_auth_token": True},
+        "login": True,
+        "directory": "Llama2-13B",
+        "prefix": "llama2-13b",
+    },
+    "qwen-14b": {
+        "checkpoint": "Qwen/Qwen-14B-Chat",
+        "auto_class": "AutoModelForCausalLM",
+        "kwargs": {"trust_remote_code": True},
+        "directory": "Qwen14B",
+        "prefix": "qwen14b",
+    },
+    "vicuna-13b": {
+        "checkpoint": "lmsys/vicuna-13b-v1.5",
+        "auto_class": "AutoModelForCausalLM",
+        "kwargs": {"trust_remote_code": True},
+        "directory": "Vicuna13B",
+        "prefix": "vicuna13b",
+        "prefixes": {"convai2": "vicuna-13b"},
+    },
+}
+
+# Vicuna with int8 linear layers by default: its ratings are saved next to the fp32 ones, as *-int8_* files, and
+# checked against them (--quantization none scores it in fp32).
+MODELS["vicuna-13b-int8"] = {**MODELS["vicuna-13b"], "quantization": "int8"}
+
+
+# Weight dtypes of the evaluators: option name and torch dtype. The models are published and were evaluated in fp32.
+DTYPES = {"fp32": "float32", "bf16": "bfloat16", "fp16": "float16"}
+
+
+# Repository root, holding _datasets and the result directories of the models.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def model_spec(name: str):
+    if name not in MODELS:
+        raise ValueError(f"Unknown model '{name}', expected one of {sorted(MODELS)}")
+    return MODELS[name]
+
+
+# Prefix of the result files of a model for a dataset (and of a renderer other than the default one, of
+# truncated prompts, of weights in reduced precision and of quantized weights).
+def file_prefix(name: str, dataset: str, renderer: str = "list", truncation=None, dtype: str = "fp32",
+                quantization: str = None):
+    spec = model_spec(name)
+    prefix = spec.get("prefixes", {}).get(dataset, spec["prefix"])
+    if renderer != "list":
+        prefix = f"{prefix}-{renderer}"
+    if truncation:
+        prefix += truncation.suffix()
+    if dtype != "fp32":
+        prefix = f"{prefix}-{dtype}"
+    return f"{prefix}-{quantization}" if quantization else prefix
+
+
+# Directory of the results of a model for a dataset and level.
+def results_dir(name: str, dataset: str, level: str, root: str = ROOT):
+    return os.path.join(root, model_spec(name)["directory"], f"{dataset}_data", f"{level}_level")
+
+
+# Load the tokenizer of a registered evaluator, or of any other checkpoint or local path.
+def load_tokenizer(name: str):
+    import transformers
+
+    if name in MODELS:
+        return transformers.AutoTokenizer.from_pretrained(MODELS[name]["checkpoint"], **MODELS[name]["kwargs"])
+    return transformers.AutoTokenizer.from_pretrained(name)
+
+
+# The transformers package of a registered evaluator: its own version when it needs one.
+def import_transformers(name: str, root: str):
+    spec = model_spec(name)
+    if "transformers_path" in spec:
+        path = os.path.join(root, spec["transformers_path"])
+        if "transformers" in sys.modules and path not in sys.path:
+            raise RuntimeError(f"'{name}' needs the transformers of {spec['transformers_path']}, "
+                               f"but another transformers is already imported")
+        if path not in sys.path:
+            sys.path.insert(0, path)
+    return importlib.import_module("transformers")
+
+
+# Load tokenizer and model of a registered evaluator, with its weights in a dtype.
+def load_model(name: str, root: str, dtype: str = "fp32"):
+    spec = model_spec(name)
+    transformers = import_transformers(name, root)
+    kwargs = dict(spec["kwargs"])
+    if dtype != "fp32":
+        import torch
+        kwargs["torch_dtype"] = getattr(torch, DTYPES[dtype])
+
+    # Suppress warnings.
+    sys.stderr = open(os.devnull, 'w')
+    try:
+        if spec.get("login"):
+            # Login to hugging face.
+            from huggingface_hub import login
+            from config import HUGGING_FACE_TOKEN
+            login(HUGGING_FACE_TOKEN)
+
+        tokenizer = transformers.AutoTokenizer.from_pretrained(spec["checkpoint"], **spec["kwargs"])
+        model = getattr(transformers, spec["auto_class"]).from_pretrained(spec["checkpoint"], **kwargs)
+    finally:
+        # Reset warnings.
+        sys.stderr.close()
+        sys.stderr = sys.__stderr__
+
+    return tokenizer, model.eval()
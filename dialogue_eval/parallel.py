@@ -0,0 +1,162 @@
+import multiprocessing
+import os
+import queue
+import resource
+import traceback
+
+from tqdm import tqdm
+
+from dialogue_eval.engine import InferenceEngine
+from dialogue_eval.scoring import normalize
+from dialogue_eval.topology import available_cpus, configure_threads, pin, release, replicate
+
+
+# Shards per worker: more shards than workers let a worker that finishes early take the next one.
+SHARDS_PER_WORKER = 4
+
+
+# Memory of the current process in bytes: resident (rss), proportional to the sharing processes (pss, from
+# /proc when available, so that pages shared copy-on-write are counted once across processes) and peak resident.
+def memory_usage():
+    usage = {"rss": 0, "pss": 0, "peak_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024}
+    try:
+        with open("/proc/self/smaps_rollup", 'r') as smaps:
+            for line in smaps:
+                name, value = line.split(":", 1)
+                if name in ("Rss", "Pss"):
+                    usage[name.lower()] = int(value.split()[0]) * 1024
+    except OSError:
+        pass
+    return usage
+
+
+# Loop of a worker process: score the shards of the task queue with its copy-on-write view of the engine (or its
+# own replica of the model, on the CPUs it is pinned to), and send the log-probabilities of every batch to the
+# result queue.
+def _worker(engine: InferenceEngine, threads: int, cpus: list, replicated: bool, tasks, results):
+    if cpus is not None:
+        pin(cpus)
+    else:
+        configure_threads(threads, 1)
+    if replicated:
+        replicate(engine.model)
+    engine.progress = False
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+
+        shard, indices, sequences = task
+        try:
+            def on_log_probs(batch, log_probs):
+                results.put(("log_probs", shard, [indices[position] for position in batch], log_probs))
+
+            InferenceEngine.score_ids(engine, sequences, on_log_probs=on_log_probs)
+            results.put(("done", shard, os.getpid(), memory_usage()))
+        except Exception:
+            results.put(("error", shard, os.getpid(), traceback.format_exc()))
+
+
+# Inference engine scoring with worker processes forked from the process holding the model, so that the workers
+# share its weights copy-on-write instead of loading a copy each (the weights are only read). Every worker runs
+# with its own torch thread budget; the sequences are split in shards that the workers take from a queue, and their
+# scores come back to this process, which reports them to the callbacks (journal, score cache) as they arrive.
+# The workers are forked once, before any parallel work of this process (OpenMP thread pools do not survive a fork).
+# With cpu_sets, worker i is pinned to cpu_sets[i] with one torch thread per CPU, and with replicated it copies the
+# weights into memory local to those CPUs (one replica per NUMA node); with release_weights as well, this process
+# then drops its own copy of the weights, and the model can no longer be used outside the workers.
+class WorkerPoolEngine(InferenceEngine):
+
+    def __init__(self, model, tokenizer, workers: int = 2, threads_per_worker: int = None, cpu_sets: list = None,
+                 replicated: bool = False, release_weights: bool = False, **engine_kwargs):
+        if cpu_sets is not None:
+            workers = len(cpu_sets)
+        if workers < 1:
+            raise ValueError("workers must be positive")
+        super().__init__(model, tokenizer, **engine_kwargs)
+
+        self.workers = workers
+        self.cpu_sets = cpu_sets
+        self.threads_per_worker = threads_per_worker or max(1, len(available_cpus()) // workers)
+        self.worker_memory = {}
+
+        context = multiprocessing.get_context("fork")
+        self.tasks = context.Queue()
+        self.results = context.Queue()
+        self.processes = [
+            context.Process(target=_worker, daemon=True,
+                            args=(self, self.threads_per_worker, cpu_sets[worker] if cpu_sets is not None else None,
+                                  replicated, self.tasks, self.results))
+            for worker in range(workers)
+        ]
+        for process in self.processes:
+            process.start()
+        if replicated and release_weights:
+            release(model)
+
+    # Shards of the sequences: contiguous runs of the sequences in token order, so that prompts sharing a prefix
+    # stay in one shard (and one prefix cache), with about the same number of tokens each.
+    def shards(self, sequences: list):
+        order = sorted(range(len(sequences)), key=lambda index: tuple(sequences[index]))
+        count = min(len(order), self.workers * SHARDS_PER_WORKER)
+        budget = sum(len(sequence) for sequence in sequences) / max(count, 1)
+
+        shards = [[]]
+        tokens = 0
+        for index in order:
+            if tokens >= budget * len(shards) and len(shards) < count:
+                shards.append([])
+            shards[-1].append(index)
+            tokens += len(sequences[index])
+        return [shard for shard in shards if shard]
+
+    # Normalized (yes, no) probabilities of pre-tokenized sequences, in input order, scored by the workers.
+    def score_ids(self, sequences: list, desc: str = "Dialogue ratings progress", on_scores=None, on_log_probs=None):
+        scores = [None] * len(sequences)
+        shards = self.shards(sequences)
+        for shard, indices in enumerate(shards):
+            self.tasks.put((shard, indices, [sequences[index] for index in indices]))
+
+        remaining = len(shards)
+        with tqdm(total=len(sequences), desc=desc, disable=not self.progress) as progress:
+            while remaining:
+                try:
+                    kind, shard, first, second = self.results.get(timeout=1)
+                except queue.Empty:
+                    dead = [process.pid for process in self.processes if not process.is_alive()]
+                    if dead:
+                        raise RuntimeError(f"Worker processes {dead} exited before finishing their shards")
+                    continue
+
+                if kind == "error":
+                    raise RuntimeError(f"Worker process {first} failed on shard {shard}:\n{second}")
+                if kind == "done":
+                    self.worker_memory[first] = second
+                    remaining -= 1
+                    continue
+
+                indices, log_probs = first, second
+                for index, (yes_log_prob, no_log_prob) in zip(indices, log_probs):
+                    scores[index] = normalize(yes_log_prob, no_log_prob)
+                if on_log_probs is not None:
+                    on_log_probs(indices, log_probs)
+                self._report(indices, scores, on_scores)
+                progress.update(len(indices))
+
+        return scores
+
+    # Memory of this process and of the workers (as of their last finished shard), in bytes.
+    def memory_report(self):
+        report = {"parent": memory_usage(), "workers": dict(self.worker_memory)}
+        report["total_pss"] = report["parent"]["pss"] + sum(usage["pss"] for usage in self.worker_memory.values())
+        return report
+
+    # Stop the workers.
+    def close(self):
+        for _ in self.processes:
+            self.tasks.put(None)
+        for process in self.processes:
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
+        self.processes = []
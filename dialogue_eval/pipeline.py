@@ -0,0 +1,126 @@
+import collections
+import contextlib
+import queue
+import threading
+import time
+
+
+# Stages of an evaluation, in pipeline order.
+STAGES = ("load", "render", "tokenize", "forward", "write")
+
+
+# Seconds spent in every stage of a pipeline, summed over the threads running it. "wait:" stages count the time
+# a stage spent blocked on a queue: the forward pass waiting for prepared prompts, or for room in the write queue.
+class StageTimer:
+
+    def __init__(self):
+        self.seconds = collections.defaultdict(float)
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.seconds[name] += time.perf_counter() - start
+
+    # Seconds per stage, the wall time since the timer started, and the busiest stage (the bottleneck).
+    def report(self):
+        with self.lock:
+            seconds = dict(self.seconds)
+        busy = {stage: seconds.get(stage, 0.0) for stage in STAGES}
+        return {"stages": seconds, "wall": time.perf_counter() - self.start, "bottleneck": max(busy, key=busy.get)}
+
+
+# Producer thread running an iterable (a generator preparing the work of a pipeline) ahead of its consumer, at most
+# depth items ahead. Iterating yields the items in order; an error of the iterable is raised where its next item
+# would be.
+class Prefetcher:
+
+    def __init__(self, items, depth: int = 1, timer: StageTimer = None):
+        # A queue of size 0 would be unbounded.
+        if depth < 1:
+            raise ValueError("depth must be positive")
+        self.items = items
+        self.timer = timer or StageTimer()
+        self.results = queue.Queue(maxsize=depth)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="prefetcher", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        iterator = iter(self.items)
+        while True:
+            try:
+                result = (next(iterator), None, False)
+            except StopIteration:
+                result = (None, None, True)
+            except Exception as error:
+                result = (None, error, True)
+            # Blocks while depth items wait for the consumer.
+            while not self.stopped.is_set():
+                try:
+                    self.results.put(result, timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+            if self.stopped.is_set() or result[2]:
+                return
+
+    def __iter__(self):
+        while True:
+            with self.timer.stage("wait:prepare"):
+                item, error, finished = self.results.get()
+            if error is not None:
+                raise error
+            if finished:
+                return
+            yield item
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+
+
+# Background thread running the write tasks of a pipeline (journal records, result files) in submission order,
+# behind a bounded queue. An error of a task is raised by every later submit and by close, and the tasks queued
+# after it are skipped, so that nothing is written behind a failed write.
+class BackgroundWriter:
+
+    def __init__(self, maxsize: int = 4096, timer: StageTimer = None):
+        self.timer = timer or StageTimer()
+        self.tasks = queue.Queue(maxsize=maxsize)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, name="writer", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                break
+            if self.error is not None:
+                continue
+            function, args = task
+            try:
+                with self.timer.stage("write"):
+                    function(*args)
+            except Exception as error:
+                self.error = error
+
+    def submit(self, function, *args):
+        if self.error is not None:
+            raise self.error
+        with self.timer.stage("wait:write"):
+            self.tasks.put((function, args))
+
+    # Run the pending tasks and stop the thread, raising the error of a task (once).
+    def close(self):
+        self.tasks.put(None)
+        self.thread.join()
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
@@ -0,0 +1,167 @@
+import collections
+import copy
+
+import torch
+
+
+# Node of the radix tree: the token ids of its edge from the parent, and the past_key_values of the prefix
+# ending at the node when they are cached.
+class _Node:
+    __slots__ = ("edge", "depth", "children", "count", "past")
+
+    def __init__(self, edge: tuple = (), depth: int = 0):
+        self.edge = edge
+        self.depth = depth
+        self.children = {}
+        self.count = 0
+        self.past = None
+
+
+# Tensors of a past_key_values: nested tuples (remote-code models), or a Cache object.
+def _tensors(past):
+    if isinstance(past, torch.Tensor):
+        yield past
+    elif isinstance(past, (tuple, list)):
+        for item in past:
+            yield from _tensors(item)
+    elif hasattr(past, "key_cache"):
+        yield from _tensors(past.key_cache)
+        yield from _tensors(past.value_cache)
+    elif hasattr(past, "layers"):
+        for layer in past.layers:
+            yield from _tensors((layer.keys, layer.values))
+
+
+def past_nbytes(past):
+    return sum(tensor.nbytes for tensor in _tensors(past))
+
+
+# Copy of a batch-1 past_key_values repeated for a batch of rows (ChatGLM3 keeps the batch in dim 1).
+def repeat_past(past, rows: int, batch_dim: int = 0):
+    if isinstance(past, torch.Tensor):
+        return past.repeat_interleave(rows, dim=batch_dim)
+    if isinstance(past, (tuple, list)):
+        return type(past)(repeat_past(item, rows, batch_dim) for item in past)
+    if past is None:
+        return None
+
+    # Cache objects are updated in place by the forward pass, so the cached one is never passed as is.
+    past = copy.deepcopy(past)
+    past.batch_repeat_interleave(rows)
+    return past
+
+
+# Radix tree over the token ids of the prompts, holding the past_key_values of shared prefixes.
+# Prompts sharing a long prefix (several responses to one context) are grouped on it, so the prefix is run once
+# and only the suffixes are scored against its cached keys/values. The cached prefixes are evicted in least
+# recently used order once they exceed max_bytes.
+class PrefixCache:
+
+    def __init__(self, max_bytes: int = 2 * 1024 ** 3, min_prefix_tokens: int = 32):
+        self.max_bytes = max_bytes
+        self.min_prefix_tokens = min_prefix_tokens
+        self.root = _Node()
+        self.cached = collections.OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    # Add a sequence to the tree, counting on every node the sequences that contain its whole prefix.
+    def insert(self, sequence: list):
+        node = self.root
+        position = 0
+        while position < len(sequence):
+            child = node.children.get(sequence[position])
+            if child is None:
+                child = _Node(tuple(sequence[position:]), len(sequence))
+                child.count = 1
+                node.children[sequence[position]] = child
+                return
+
+            # Length of the match between the rest of the sequence and the edge of the child.
+            match = 0
+            while match < len(child.edge) and position + match < len(sequence) and \
+                    child.edge[match] == sequence[position + match]:
+                match += 1
+
+            if match < len(child.edge):
+                # Split the edge: every sequence through the child also goes through the new middle node.
+                middle = _Node(child.edge[:match], node.depth + match)
+                middle.count = child.count
+                child.edge = child.edge[match:]
+                middle.children[child.edge[0]] = child
+                node.children[sequence[position]] = middle
+                child = middle
+
+            child.count += 1
+            node = child
+            position += match
+
+    # Forget the sequences counted by insert(), keeping the nodes and their cached prefixes.
+    def reset_counts(self):
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            node.count = 0
+            stack.extend(node.children.values())
+
+    # Node of the prefix a sequence should share: the one saving the most tokens (depth x other sequences),
+    # at least min_prefix_tokens long and leaving at least one token to score. None if there is no such node.
+    def shared_prefix(self, sequence: list):
+        best, best_saving = None, 0
+        node = self.root
+        position = 0
+        while position < len(sequence):
+            node = node.children.get(sequence[position])
+            if node is None or tuple(sequence[position:position + len(node.edge)]) != node.edge:
+                break
+            position += len(node.edge)
+
+            # A prefix that is already cached is not run again, even for its first sequence.
+            saving = node.depth * (node.count - (node.past is None))
+            if self.min_prefix_tokens <= node.depth < len(sequence) and saving > best_saving:
+                best, best_saving = node, saving
+        return best
+
+    # Indices of the sequences grouped by shared prefix node, and the indices of the remaining sequences.
+    def group(self, sequences: list):
+        self.reset_counts()
+        for sequence in sequences:
+            self.insert(sequence)
+
+        groups = collections.OrderedDict()
+        rest = []
+        for index, sequence in enumerate(sequences):
+            node = self.shared_prefix(sequence)
+            if node is None:
+                rest.append(index)
+            else:
+                groups.setdefault(node, []).append(index)
+
+        # A prefix chosen by a single sequence saves nothing.
+        for node, indices in list(groups.items()):
+            if len(indices) < 2 and node.past is None:
+                rest.extend(indices)
+                del groups[node]
+
+        return list(groups.items()), sorted(rest)
+
+    # Cached past_key_values of a node, computed with compute() on a miss.
+    def past(self, node: _Node, compute):
+        if node.past is not None:
+            self.hits += 1
+            self.cached.move_to_end(node)
+            return node.past
+
+        self.misses += 1
+        past = compute()
+        nbytes = past_nbytes(past)
+        if nbytes <= self.max_bytes:
+            while self.cached and self.nbytes + nbytes > self.max_bytes:
+                evicted, evicted_nbytes = self.cached.popitem(last=False)
+                evicted.past = None
+                self.nbytes -= evicted_nbytes
+            node.past = past
+            self.cached[node] = nbytes
+            self.nbytes += nbytes
+        return past
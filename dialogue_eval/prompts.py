@@ -0,0 +1,100 @@
+import hashlib
+import itertools
+
+from dialogue_eval.templates import PromptTemplate
+
+
+# Prompt for turn-level evaluation.
+TURN_TEMPLATE = """
+    ### Context:
+    {context}
+    
+    ### Response:
+    {response}
+    
+    ## Instruction:
+    Above is a dialogue context and the corresponding response.
+    
+    Question: Is the overall quality of the response satisfactory to the context?
+
+    ### Your Answer:
+    """
+
+# Prompt for dialogue-level evaluation.
+DIALOGUE_TEMPLATE = """
+    ### Dialogues:
+    {context_response}
+
+    ## Instruction:
+    Above is a dialogue.
+
+    Question: Is the overall quality of the dialogue satisfactory?
+
+    ### Your Answer:
+    """
+
+# Version of the prompts, changed by any edit of the templates (results of other prompts are never mixed).
+PROMPT_VERSION = hashlib.sha1((TURN_TEMPLATE + DIALOGUE_TEMPLATE).encode()).hexdigest()[:8]
+
+# Layouts of the turns in the prompts: "list" writes them as a Python list, as the original prompts did,
+# "lines" writes one "A: turn" line per turn, without the brackets, quotes and escapes of the list.
+RENDERERS = ("list", "lines")
+
+
+# Version of the prompts written with a renderer.
+def prompt_version(renderer: str = "list"):
+    return PROMPT_VERSION if renderer == "list" else f"{PROMPT_VERSION}-{renderer}"
+
+
+# Templates assembled at the token level.
+TURN = PromptTemplate(TURN_TEMPLATE)
+DIALOGUE = PromptTemplate(DIALOGUE_TEMPLATE)
+
+
+# Turns written as a Python list, as the original prompts showed them, whatever iterable holds them.
+def _turns_repr(turns):
+    return "[" + ", ".join(repr(turn) for turn in turns) + "]"
+
+
+# Turns written one per line after a short label of their speaker (A, B, ... in order of appearance). Speakers
+# are any hashable values aligned with the turns; turns that are None are left out.
+def _turn_lines(turns, speakers):
+    labels = {}
+    lines = []
+    for turn, speaker in zip(turns, speakers):
+        if turn is None:
+            continue
+        label = labels.setdefault(speaker, chr(ord("A") + len(labels)))
+        lines.append(f"{label}: {turn}")
+    return lines
+
+
+# Two speakers taking turns.
+def _alternating():
+    return (position % 2 for position in itertools.count())
+
+
+# Field values of the turn prompt (with the list renderer, the response is shown as a one-turn list, like the
+# context).
+def turn_fields(context, response: str, speakers=None, renderer: str = "list"):
+    if renderer == "lines":
+        lines = _turn_lines(itertools.chain(context, (response,)), speakers or _alternating())
+        return {"context": "\n".join(lines[:-1]), "response": lines[-1]}
+    return {"context": _turns_repr(context), "response": _turns_repr((response,))}
+
+
+# Field values of the dialogue prompt.
+def dialogue_fields(context_response, speakers=None, renderer: str = "list"):
+    if renderer == "lines":
+        return {"context_response": "\n".join(_turn_lines(context_response, speakers or _alternating()))}
+    return {"context_response": _turns_repr(context_response)}
+
+
+# Create prompt for turn.
+def create_turn_prompt(context, response: str):
+    return TURN.render(**turn_fields(context, response))
+
+
+# Create prompt for dialogue.
+def create_dialogue_prompt(context_response):
+    return DIALOGUE.render(**dialogue_fields(context_response))
@@ -0,0 +1,163 @@
+import json
+import os
+
+import torch
+
+from dialogue_eval.journal import write_json_atomic
+from dialogue_eval.models import ROOT, model_spec
+from dialogue_eval.scoring import output_layer_name
+
+
+# Default location of the quantized weights, in the repository root.
+DEFAULT_DIR = os.path.join(ROOT, ".cache", "quantized")
+
+# Weight quantizations of the linear layers: int8 with dynamic quantization of the activations (int8 matmuls),
+# or weight-only int4 in groups, dequantized to the dtype of the activations by every forward pass.
+QUANTIZATIONS = ("int8", "int4")
+
+# Weights sharing a scale and a zero point in int4.
+INT4_GROUP_SIZE = 128
+
+# Version of the cached quantized weights, raised when the quantized layers of a model change.
+CACHE_VERSION = 2
+
+
+# Linear layer with weight-only int4 weights: two 4-bit values per byte, with a scale and a zero point (min-max,
+# asymmetric) per group of group_size input features.
+class Int4Linear(torch.nn.Module):
+
+    def __init__(self, in_features: int, out_features: int, bias: bool = True, group_size: int = INT4_GROUP_SIZE):
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.group_size = group_size
+        groups = -(-in_features // group_size)
+        self.register_buffer("qweight", torch.zeros(out_features, groups * group_size // 2, dtype=torch.uint8))
+        self.register_buffer("scales", torch.zeros(out_features, groups))
+        self.register_buffer("zeros", torch.zeros(out_features, groups))
+        self.bias = torch.nn.Parameter(torch.zeros(out_features), requires_grad=False) if bias else None
+
+    @classmethod
+    def from_linear(cls, linear: torch.nn.Linear, group_size: int = INT4_GROUP_SIZE):
+        module = cls(linear.in_features, linear.out_features, linear.bias is not None, group_size)
+        weight = linear.weight.detach().float()
+        padding = module.scales.shape[1] * group_size - linear.in_features
+        groups = torch.nn.functional.pad(weight, (0, padding)).view(linear.out_features, -1, group_size)
+
+        low, high = groups.amin(-1), groups.amax(-1)
+        scales = ((high - low) / 15).clamp(min=1e-8)
+        zeros = (-low / scales).round().clamp(0, 15)
+        values = (groups / scales[..., None] + zeros[..., None]).round().clamp(0, 15).to(torch.uint8)
+        values = values.view(linear.out_features, -1, 2)
+
+        module.qweight.copy_(values[..., 0] | (values[..., 1] << 4))
+        module.scales.copy_(scales)
+        module.zeros.copy_(zeros)
+        if linear.bias is not None:
+            module.bias.data = linear.bias.detach().float()
+        return module
+
+    # Weights in a dtype.
+    def dequantize(self, dtype):
+        values = torch.stack((self.qweight & 0x0F, self.qweight >> 4), -1)
+        values = values.view(self.out_features, -1, self.group_size)
+        weight = (values.float() - self.zeros[..., None]) * self.scales[..., None]
+        return weight.view(self.out_features, -1)[:, :self.in_features].to(dtype)
+
+    def forward(self, inputs):
+        bias = self.bias.to(inputs.dtype) if self.bias is not None else None
+        return torch.nn.functional.linear(inputs, self.dequantize(inputs.dtype), bias)
+
+    def extra_repr(self):
+        return f"in_features={self.in_features}, out_features={self.out_features}, group_size={self.group_size}"
+
+
+# Names of the linear layers quantized in a model: all but the output layer (the one the restricted LM head is
+# taken from), whose Yes/No rows score the prompts.
+def _linear_names(model):
+    output = output_layer_name(model)
+    return [name for name, module in model.named_modules() if isinstance(module, torch.nn.Linear) and name != output]
+
+
+def _set_module(model, name: str, module):
+    parent_name, _, attribute = name.rpartition(".")
+    setattr(model.get_submodule(parent_name), attribute, module)
+
+
+# Quantized layer replacing a linear layer: quantized from its weights, or empty (to load quantized weights in).
+def _quantized_module(linear: torch.nn.Linear, method: str, empty: bool = False):
+    if method == "int4":
+        if empty:
+            return Int4Linear(linear.in_features, linear.out_features, linear.bias is not None)
+        return Int4Linear.from_linear(linear)
+
+    from torch.ao.nn.quantized.dynamic import Linear as DynamicQuantizedLinear
+    from torch.ao.quantization import default_dynamic_qconfig
+
+    if empty:
+        return DynamicQuantizedLinear(linear.in_features, linear.out_features, linear.bias is not None,
+                                      dtype=torch.qint8)
+    linear.qconfig = default_dynamic_qconfig
+    return DynamicQuantizedLinear.from_float(linear)
+
+
+# Quantize the linear layers of a model in place. The method is kept on the model, so that its scores get their
+# own score cache namespace.
+def quantize(model, method: str):
+    if method not in QUANTIZATIONS:
+        raise ValueError(f"Unknown quantization '{method}', expected one of {QUANTIZATIONS}")
+    if method == "int8" and model.dtype != torch.float32:
+        raise ValueError(f"int8 quantization needs fp32 activations, the model is in {model.dtype}")
+    with torch.no_grad():
+        for name in _linear_names(model):
+            _set_module(model, name, _quantized_module(model.get_submodule(name), method))
+    model.quantization = method
+    return model
+
+
+# Bytes of the parameters and buffers of a model, quantized weights included.
+def weight_bytes(model):
+    tensors = []
+    for value in model.state_dict().values():
+        tensors.extend(value if isinstance(value, tuple) else [value])
+    return sum(tensor.numel() * tensor.element_size() for tensor in tensors if isinstance(tensor, torch.Tensor))
+
+
+# Quantized weights of a model, cached in quantized_dir: <model>-<dtype>-<method>.pt, holding the state of its
+# quantized layers, and a JSON file with the torch version, checkpoint and revision they were made with.
+def quantized_path(name: str, method: str, dtype: str = "fp32", quantized_dir: str = DEFAULT_DIR):
+    return os.path.join(quantized_dir, f"{name}-{dtype}-{method}.pt")
+
+
+# Quantize the linear layers of a loaded model of a registered evaluator in place, with the cached quantized
+# weights when they were made by this torch version from the same checkpoint and revision, and cache them otherwise.
+def load_quantized(model, name: str, method: str, dtype: str = "fp32", quantized_dir: str = DEFAULT_DIR):
+    file_path = quantized_path(name, method, dtype, quantized_dir)
+    metadata_path = os.path.splitext(file_path)[0] + ".json"
+    metadata = {"version": CACHE_VERSION, "model": name, "checkpoint": model_spec(name)["checkpoint"],
+                "commit_hash": getattr(model.config, "_commit_hash", None), "method": method, "dtype": dtype,
+                "torch": torch.__version__}
+
+    names = _linear_names(model)
+    cached = None
+    if os.path.exists(file_path) and os.path.exists(metadata_path):
+        with open(metadata_path, 'r') as metadata_file:
+            if json.load(metadata_file) == metadata:
+                cached = torch.load(file_path, weights_only=True)
+
+    if cached is None:
+        quantize(model, method)
+        states = {module_name: model.get_submodule(module_name).state_dict() for module_name in names}
+        os.makedirs(quantized_dir, exist_ok=True)
+        torch.save(states, f"{file_path}.tmp")
+        os.replace(f"{file_path}.tmp", file_path)
+        write_json_atomic(metadata_path, metadata)
+        return model
+
+    with torch.no_grad():
+        for module_name in names:
+            module = _quantized_module(model.get_submodule(module_name), method, empty=True)
+            module.load_state_dict(cached[module_name])
+            _set_module(model, module_name, module)
+    model.quantization = method
+    return model
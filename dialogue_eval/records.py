@@ -0,0 +1,50 @@
+import itertools
+import types
+
+
+# Read-only example of a dataset: the turns of the context as a tuple, the response to rate (None for
+# dialogue-level examples without a separate response), the mean human rating, dataset metadata (e.g. the
+# system of a FED example) and the speaker of every turn when the dataset records it (None when the speakers
+# simply alternate).
+class Example:
+    __slots__ = ("id_dialogue", "context", "response", "score", "metadata", "speakers")
+
+    def __init__(self, id_dialogue: int, context: tuple, response: str = None, score: float = None,
+                 metadata: dict = None, speakers: tuple = None):
+        object.__setattr__(self, "id_dialogue", id_dialogue)
+        object.__setattr__(self, "context", tuple(context))
+        object.__setattr__(self, "response", response)
+        object.__setattr__(self, "score", score)
+        object.__setattr__(self, "metadata", types.MappingProxyType(dict(metadata or {})))
+        object.__setattr__(self, "speakers", tuple(speakers) if speakers is not None else None)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is read-only")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"{type(self).__name__} is read-only")
+
+    # Pickled through the constructor, since the attributes are read-only.
+    def __reduce__(self):
+        return Example, (self.id_dialogue, self.context, self.response, self.score, dict(self.metadata),
+                         self.speakers)
+
+    def __repr__(self):
+        return f"Example({self.id_dialogue!r}, {self.context!r}, {self.response!r}, {self.score!r})"
+
+    # Turns of the whole dialogue, the context followed by the response, without copying them.
+    def turns(self):
+        if self.response is None:
+            return iter(self.context)
+        return itertools.chain(self.context, (self.response,))
+
+    # Speakers of the turns, in the order of turns(): the recorded ones, or two alternating speakers.
+    def turn_speakers(self):
+        if self.speakers is not None:
+            return iter(self.speakers)
+        return (position % 2 for position in itertools.count())
+
+
+# Mean of the ratings of the annotators.
+def mean_rating(ratings: list):
+    return sum(ratings) / len(ratings)
@@ -0,0 +1,115 @@
+import hashlib
+import os
+import sqlite3
+import time
+
+from dialogue_eval.models import ROOT
+
+
+# Default location of the score cache, in the repository root.
+DEFAULT_PATH = os.path.join(ROOT, ".cache", "scores.sqlite")
+
+# Bytes counted for an entry besides its key: the two log-probabilities and the last use time.
+_ENTRY_BYTES = 24
+
+# SQLite limits the number of parameters of a query.
+_CHUNK = 500
+
+
+# Hash of everything a score depends on besides the prompt: checkpoint and revision, weights dtype and
+# quantization, scoring mode and label tokens.
+def cache_namespace(model, mode: str, label_ids: list):
+    config = model.config
+    fields = [getattr(config, "_name_or_path", "") or getattr(model, "name_or_path", ""),
+              getattr(config, "_commit_hash", None) or "", str(getattr(model, "dtype", "")), mode,
+              ",".join(str(label_id) for label_id in label_ids)]
+    if getattr(model, "quantization", None):
+        fields.append(model.quantization)
+    return hashlib.sha256("\0".join(fields).encode()).hexdigest()
+
+
+# Key of a rendered prompt in a namespace.
+def cache_key(namespace: str, prompt: str):
+    return hashlib.sha256(f"{namespace}\0{prompt}".encode()).hexdigest()
+
+
+def _chunks(items: list):
+    for start in range(0, len(items), _CHUNK):
+        yield items[start:start + _CHUNK]
+
+
+# Persistent content-addressed cache of the raw (yes, no) log-probabilities of prompts, in SQLite.
+# Entries are evicted in least recently used order once they exceed max_bytes. Hits and misses are counted in
+# the database, across runs.
+class ScoreCache:
+
+    def __init__(self, file_path: str = DEFAULT_PATH, max_bytes: int = 1024 ** 3):
+        os.makedirs(os.path.dirname(file_path) or ".", exist_ok=True)
+        self.file_path = file_path
+        self.max_bytes = max_bytes
+        self.connection = sqlite3.connect(file_path)
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS scores "
+                                    "(key TEXT PRIMARY KEY, yes REAL, no REAL, size INTEGER, last_used REAL)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS scores_last_used ON scores (last_used)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER)")
+            self.connection.executemany("INSERT OR IGNORE INTO counters VALUES (?, 0)", [("hits",), ("misses",)])
+
+    # Cached (yes, no) log-probabilities of the keys found, by key.
+    def get_many(self, keys: list):
+        found = {}
+        for chunk in _chunks(list(set(keys))):
+            placeholders = ",".join("?" * len(chunk))
+            rows = self.connection.execute(f"SELECT key, yes, no FROM scores WHERE key IN ({placeholders})", chunk)
+            found.update((key, (yes, no)) for key, yes, no in rows)
+
+        now = time.time()
+        with self.connection:
+            self.connection.executemany("UPDATE scores SET last_used = ? WHERE key = ?", [(now, key) for key in found])
+            self.connection.execute("UPDATE counters SET value = value + ? WHERE name = 'hits'",
+                                    (sum(key in found for key in keys),))
+            self.connection.execute("UPDATE counters SET value = value + ? WHERE name = 'misses'",
+                                    (sum(key not in found for key in keys),))
+        return found
+
+    # Store (key, (yes, no)) log-probabilities, then evict the least recently used entries over max_bytes.
+    def put_many(self, items: list):
+        now = time.time()
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO scores VALUES (?, ?, ?, ?, ?)",
+                                        [(key, yes, no, len(key) + _ENTRY_BYTES, now) for key, (yes, no) in items])
+        self.evict()
+
+    def evict(self):
+        excess = self.nbytes() - self.max_bytes
+        if excess <= 0:
+            return
+
+        evicted = []
+        for key, size in self.connection.execute("SELECT key, size FROM scores ORDER BY last_used"):
+            evicted.append(key)
+            excess -= size
+            if excess <= 0:
+                break
+        with self.connection:
+            self.connection.executemany("DELETE FROM scores WHERE key = ?", [(key,) for key in evicted])
+
+    def nbytes(self):
+        return self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM scores").fetchone()[0]
+
+    # Entries, size and lifetime hit rate of the cache.
+    def stats(self):
+        counters = dict(self.connection.execute("SELECT name, value FROM counters"))
+        lookups = counters["hits"] + counters["misses"]
+        return {
+            "path": self.file_path,
+            "entries": self.connection.execute("SELECT COUNT(*) FROM scores").fetchone()[0],
+            "bytes": self.nbytes(),
+            "max_bytes": self.max_bytes,
+            "hits": counters["hits"],
+            "misses": counters["misses"],
+            "hit_rate": counters["hits"] / lookups if lookups else 0.0,
+        }
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,98 @@
+import contextlib
+import functools
+import inspect
+import math
+
+import torch
+
+
+# Answers of the Yes/No question asked in the prompts.
+LABELS = ("Yes", "No")
+
+
+# Token ids of the labels, encoded as in the original inference scripts.
+def label_token_ids(tokenizer, labels: tuple = LABELS):
+    label_ids = []
+    for label in labels:
+        token_ids = tokenizer.encode(label, add_special_tokens=False)
+        if len(token_ids) != 1:
+            raise ValueError(f"Label '{label}' is not a single token for this tokenizer: {token_ids}")
+        label_ids.append(token_ids[0])
+    return label_ids
+
+
+# Forward arguments that restrict the LM head to the last position, when the model supports them.
+@functools.lru_cache(maxsize=None)
+def _last_logits_kwargs(model_class):
+    parameters = inspect.signature(model_class.forward).parameters
+    if "logits_to_keep" in parameters:
+        return {"logits_to_keep": 1}
+    if "num_logits_to_keep" in parameters:
+        return {"num_logits_to_keep": 1}
+    # ChatGLM3.
+    if "return_last_logit" in parameters:
+        return {"return_last_logit": True}
+    return {}
+
+
+def last_logits_kwargs(model):
+    return _last_logits_kwargs(type(model))
+
+
+# Log-probabilities of the labels given the logits of the next token.
+def label_log_probs(logits: torch.Tensor, label_ids: list):
+    log_probs = torch.nn.functional.log_softmax(logits.float(), dim=-1)
+    return [log_probs[..., label_id] for label_id in label_ids]
+
+
+# Normalized probability as in the paper ("Yes" is our score to considering).
+def normalize(yes_log_prob: float, no_log_prob: float):
+    yes = 1 / (1 + math.exp(no_log_prob - yes_log_prob))
+    return yes, 1 - yes
+
+
+# Name of the output layer (LM head) of the model.
+def output_layer_name(model):
+    output_layer = model.get_output_embeddings()
+    if output_layer is None:
+        # ChatGLM3 keeps its LM head in transformer.output_layer.
+        output_layer = model.transformer.output_layer
+
+    for name, module in model.named_modules():
+        if module is output_layer:
+            return name
+    raise ValueError(f"Output layer not found in {type(model).__name__}")
+
+
+# LM head restricted to the rows of the label tokens: its logits are the label logits of the full head.
+def label_head(model, label_ids: list):
+    output_layer = model.get_submodule(output_layer_name(model))
+
+    with torch.no_grad():
+        weight = output_layer.weight[label_ids]
+        if type(output_layer).__name__ == "NormHead":
+            # Baichuan2 normalizes the rows of its LM head.
+            weight = torch.nn.functional.normalize(weight)
+
+        head = torch.nn.Linear(weight.shape[1], len(label_ids), bias=output_layer.bias is not None,
+                               device=weight.device, dtype=weight.dtype)
+        head.weight.copy_(weight)
+        if output_layer.bias is not None:
+            head.bias.copy_(output_layer.bias[label_ids])
+
+    return head.eval()
+
+
+# Temporarily replace the output layer of the model.
+@contextlib.contextmanager
+def swapped_output_layer(model, head):
+    name = output_layer_name(model)
+    parent_name, _, attribute = name.rpartition(".")
+    parent = model.get_submodule(parent_name)
+
+    output_layer = getattr(parent, attribute)
+    setattr(parent, attribute, head)
+    try:
+        yield
+    finally:
+        setattr(parent, attribute, output_layer)
@@ -0,0 +1,129 @@
+import torch
+from tqdm import tqdm
+
+from dialogue_eval.engine import InferenceEngine
+from dialogue_eval.scoring import label_log_probs, normalize
+
+
+# Models whose decoder layers can be run one at a time with a prepared 4D mask and rotary embeddings.
+STREAMED_MODEL_TYPES = ("llama",)
+
+
+# Inference engine for models larger than the memory: the weights stay in the memory-mapped file of a converted
+# checkpoint and the sequences go through the decoder one layer at a time. Every layer runs on all the batches of
+# a wave (up to stream_tokens padded tokens, whose hidden states are kept in memory) before the next one, so that
+# reading a layer from disk is paid once per wave instead of once per batch; the next window layers are read
+# ahead, and a layer is dropped from memory once the wave went through it. The restricted LM head is checked
+# against the full-vocabulary one on the first batch, from the same hidden states.
+class LayerStreamingEngine(InferenceEngine):
+
+    def __init__(self, model, tokenizer, window: int = 2, stream_tokens: int = 65536, **engine_kwargs):
+        model_type = getattr(model.config, "model_type", None)
+        if model_type not in STREAMED_MODEL_TYPES:
+            raise ValueError(f"Layer streaming needs a model among {STREAMED_MODEL_TYPES}, not '{model_type}'")
+        if getattr(model, "mapped_weights", None) is None:
+            raise ValueError("Layer streaming needs the memory-mapped weights of a converted checkpoint "
+                             "(python -m dialogue_eval convert)")
+        if window < 1 or stream_tokens < 1:
+            raise ValueError("window and stream_tokens must be positive")
+        if engine_kwargs.get("packing"):
+            raise ValueError("Layer streaming does not pack prompts")
+        # Prefixes are not cached: their past_key_values would hold every layer.
+        engine_kwargs["prefix_cache_bytes"] = 0
+        super().__init__(model, tokenizer, **engine_kwargs)
+
+        self.window = window
+        self.stream_tokens = stream_tokens
+        self.weights = model.mapped_weights
+        self.decoder = model.get_decoder()
+        layers_name = next(name for name, module in model.named_modules() if module is self.decoder.layers)
+        self.layer_tensors = [[name for name in self.weights.ranges if name.startswith(f"{layers_name}.{layer}.")]
+                              for layer in range(len(self.decoder.layers))]
+        for names in self.layer_tensors:
+            self.weights.release(names)
+
+    # Batches of sequences grouped in waves of at most stream_tokens padded tokens (a larger batch is a wave).
+    def waves(self, batches: list, lengths: list):
+        wave = []
+        tokens = 0
+        for batch in batches:
+            padded = len(batch) * lengths[batch[0]]
+            if wave and tokens + padded > self.stream_tokens:
+                yield wave
+                wave = []
+                tokens = 0
+            wave.append(batch)
+            tokens += padded
+        if wave:
+            yield wave
+
+    # Final hidden states of the last token of every sequence of a wave (a list of batches of left-padded
+    # sequences), in order, running every layer on all the batches before the next layer.
+    def stream(self, batches: list):
+        dtype = self.model.dtype
+        states = []
+        for sequences in batches:
+            input_ids, attention_mask = self.collate(sequences)
+            width = input_ids.shape[1]
+            position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+            allowed = torch.ones(width, width, dtype=torch.bool).tril() & attention_mask.bool()[:, None, :]
+            mask = torch.zeros(len(sequences), 1, width, width, dtype=dtype)
+            mask.masked_fill_(~allowed[:, None], torch.finfo(dtype).min)
+
+            hidden_states = self.decoder.embed_tokens(input_ids)
+            states.append([hidden_states, mask, position_ids, self.decoder.rotary_emb(hidden_states, position_ids)])
+
+        for layer, module in enumerate(self.decoder.layers):
+            for names in self.layer_tensors[layer:layer + self.window]:
+                self.weights.prefetch(names)
+            for state in states:
+                output = module(state[0], attention_mask=state[1], position_ids=state[2], position_embeddings=state[3])
+                state[0] = output[0] if isinstance(output, tuple) else output
+            self.weights.release(self.layer_tensors[layer])
+
+        # Sequences are left-padded: the last position is the last token of every row.
+        return torch.cat([self.decoder.norm(state[0][:, -1]) for state in states])
+
+    # Label log-probabilities of final hidden states, one (yes, no) pair per row.
+    def head_log_probs(self, hidden_states: torch.Tensor, mode: str = None):
+        if (mode or self.mode) == "restricted":
+            logits, label_ids = self.label_head(hidden_states), list(range(len(self.label_ids)))
+        else:
+            logits, label_ids = self.model.get_output_embeddings()(hidden_states), self.label_ids
+        yes_log_probs, no_log_probs = label_log_probs(logits, label_ids)
+        return list(zip(yes_log_probs.tolist(), no_log_probs.tolist()))
+
+    # Check that the restricted LM head gives the full-vocabulary scores of final hidden states.
+    def verify_heads(self, hidden_states: torch.Tensor):
+        full = self.head_log_probs(hidden_states, "full")
+        restricted = self.head_log_probs(hidden_states, "restricted")
+
+        deviation = max(abs(normalize(*a)[0] - normalize(*b)[0]) for a, b in zip(full, restricted))
+        if deviation > self.tolerance:
+            raise ValueError(f"Restricted LM head deviates from the full-vocabulary scores by {deviation:.2e} "
+                             f"(tolerance {self.tolerance:.0e})")
+        self.verified = True
+
+    # Normalized (yes, no) probabilities of pre-tokenized sequences, in input order, a wave at a time.
+    # on_scores(indices, scores) and on_log_probs(indices, log_probs) are called after every wave.
+    def score_ids(self, sequences: list, desc: str = "Dialogue ratings progress", on_scores=None, on_log_probs=None):
+        scores = [None] * len(sequences)
+        lengths = [len(sequence) for sequence in sequences]
+
+        with tqdm(total=len(sequences), desc=desc, disable=not self.progress) as progress:
+            for wave in self.waves(list(self.batches(lengths)), lengths):
+                indices = [index for batch in wave for index in batch]
+                with torch.no_grad():
+                    hidden_states = self.stream([[sequences[index] for index in batch] for batch in wave])
+                    if not self.verified:
+                        self.verify_heads(hidden_states[:len(wave[0])])
+                    log_probs = self.head_log_probs(hidden_states)
+
+                for index, (yes_log_prob, no_log_prob) in zip(indices, log_probs):
+                    scores[index] = normalize(yes_log_prob, no_log_prob)
+                if on_log_probs is not None:
+                    on_log_probs(indices, log_probs)
+                self._report(indices, scores, on_scores)
+                progress.update(len(indices))
+
+        return scores
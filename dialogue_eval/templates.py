@@ -0,0 +1,126 @@
+import re
+import string
+import weakref
+
+
+# Text tokenized before every piece but the first, and removed from its ids: tokenizers that add a prefix space
+# at the start of a text (SentencePiece) would otherwise tokenize a piece differently than inside the prompt.
+ANCHOR = "."
+
+
+# Token ids of prompts, without special tokens (the prompts are scored as they are written).
+def tokenize_prompts(tokenizer, prompts: list):
+    if not prompts:
+        return []
+    return tokenizer(list(prompts), add_special_tokens=False)["input_ids"]
+
+
+# Token ids of texts tokenized after the anchor, without the ids of the anchor. None if the anchor is not
+# tokenized the same way at the start of every text.
+def _anchored_ids(tokenizer, texts: list):
+    anchor_ids = tokenize_prompts(tokenizer, [ANCHOR])[0]
+    pieces = []
+    for ids in tokenize_prompts(tokenizer, [ANCHOR + text for text in texts]):
+        if ids[:len(anchor_ids)] != anchor_ids:
+            return None
+        pieces.append(ids[len(anchor_ids):])
+    return pieces
+
+
+# Prompt template assembled at the token level: the constant segments are tokenized once per tokenizer, and for
+# every prompt only the values of the fields are tokenized and concatenated with them.
+# Boundary rule: every field value is tokenized together with the whitespace that precedes it in the template and
+# between the constant segments around it (a window); its ids are kept only when the window starts with the ids of
+# the constant before it and ends with the ids of the constant after it, i.e. when the tokenizer splits the text at
+# both ends of the field and tokenizes the field alike between the constants of the prompt. Every field start and
+# end of every prompt is checked this way, and a prompt with a field failing it is tokenized as a full string.
+class PromptTemplate:
+
+    def __init__(self, template: str):
+        self.template = template
+
+        # Pieces of the template: (constant text, None) or (whitespace before the field, field name).
+        self.pieces = []
+        for literal, field, _, _ in string.Formatter().parse(template):
+            if field is None:
+                self.pieces.append((literal, None))
+                continue
+            head, whitespace = re.match(r"(.*?)(\s*)$", literal, re.DOTALL).groups()
+            if head:
+                self.pieces.append((head, None))
+            self.pieces.append((whitespace, field))
+
+        # Compiled pieces per tokenizer, dropped with it (an id could be reused by another tokenizer).
+        self.compiled = weakref.WeakKeyDictionary()
+
+    def render(self, **values):
+        return self.template.format(**values)
+
+    # Token ids of the constant pieces for a tokenizer, or None if they cannot be tokenized apart (the anchor merges
+    # with them, or two fields are next to each other).
+    def compile(self, tokenizer):
+        if tokenizer not in self.compiled:
+            fields = [field is not None for _, field in self.pieces]
+            constants = [(position, text) for position, (text, field) in enumerate(self.pieces) if field is None]
+            ids = {}
+            if constants and constants[0][0] == 0:
+                ids[0] = tokenize_prompts(tokenizer, [constants[0][1]])[0]
+                constants = constants[1:]
+
+            anchored = _anchored_ids(tokenizer, [text for _, text in constants])
+            if anchored is None or any(first and second for first, second in zip(fields, fields[1:])):
+                self.compiled[tokenizer] = None
+            else:
+                ids.update((position, piece_ids) for (position, _), piece_ids in zip(constants, anchored))
+                self.compiled[tokenizer] = ids
+        return self.compiled[tokenizer]
+
+    # Token ids of the prompts of a list of field values, assembled from the compiled pieces, with None for the
+    # prompts that do not follow the boundary rule (all of them if the template cannot be compiled).
+    def assemble(self, tokenizer, values: list):
+        constants = self.compile(tokenizer)
+        if constants is None:
+            return [None] * len(values)
+        anchor_ids = tokenize_prompts(tokenizer, [ANCHOR])[0]
+
+        fields = {}
+        for position, (whitespace, field) in enumerate(self.pieces):
+            if field is None:
+                continue
+            # Window of the field: the constant before it (after the anchor unless it starts the prompt), the field
+            # and the constant after it.
+            head = ANCHOR if position > 1 else ""
+            left = self.pieces[position - 1][0] if position > 0 else ""
+            right = self.pieces[position + 1][0] if position + 1 < len(self.pieces) else ""
+            prefix = (anchor_ids if position > 1 else []) + (constants[position - 1] if position > 0 else [])
+            suffix = constants[position + 1] if position + 1 < len(self.pieces) else []
+
+            # Values repeated across prompts (the context of the USR responses) are tokenized once.
+            texts = list(dict.fromkeys(whitespace + value[field] for value in values))
+            ids = {}
+            for text, window in zip(texts, tokenize_prompts(tokenizer, [head + left + text + right for text in texts])):
+                end = len(window) - len(suffix)
+                split = end >= len(prefix) and window[:len(prefix)] == prefix and window[end:] == suffix
+                ids[text] = window[len(prefix):end] if split else None
+            fields[position] = [ids[whitespace + value[field]] for value in values]
+
+        sequences = []
+        for row in range(len(values)):
+            sequence = []
+            for position, (_, field) in enumerate(self.pieces):
+                piece_ids = constants[position] if field is None else fields[position][row]
+                if piece_ids is None:
+                    sequence = None
+                    break
+                sequence.extend(piece_ids)
+            sequences.append(sequence)
+        return sequences
+
+    # Token ids of the prompts of a list of field values: assembled from the compiled pieces when they follow the
+    # boundary rule, otherwise the tokenization of the rendered prompt.
+    def token_ids(self, tokenizer, values: list):
+        sequences = self.assemble(tokenizer, values)
+        rows = [row for row, sequence in enumerate(sequences) if sequence is None]
+        for row, sequence in zip(rows, tokenize_prompts(tokenizer, [self.render(**values[row]) for row in rows])):
+            sequences[row] = sequence
+        return sequences
@@ -0,0 +1,98 @@
+import hashlib
+import json
+import os
+import weakref
+
+import numpy as np
+
+from dialogue_eval.models import ROOT
+from dialogue_eval.prompts import PROMPT_VERSION
+from dialogue_eval.templates import tokenize_prompts
+
+
+# Default location of the token cache, in the repository root.
+DEFAULT_DIR = os.path.join(ROOT, ".cache", "tokens")
+
+
+# Hash of what a tokenizer does: the serialized fast tokenizer, or the vocabulary and special tokens of a slow
+# (remote-code) one. Tokenizers sharing the hash share the cached token ids, e.g. the Llama tokenizer of
+# Llama2, Vicuna and Chimera.
+def tokenizer_hash(tokenizer):
+    digest = hashlib.sha256()
+    backend = getattr(tokenizer, "backend_tokenizer", None)
+    if backend is not None:
+        digest.update(backend.to_str().encode())
+    else:
+        digest.update(type(tokenizer).__name__.encode())
+        digest.update(json.dumps(sorted(tokenizer.get_vocab().items())).encode())
+    digest.update(json.dumps(tokenizer.special_tokens_map, sort_keys=True, default=str).encode())
+    return digest.hexdigest()
+
+
+# Token ids of the prompts of a dataset per tokenizer, as flat int32 tokens plus int64 offsets on disk.
+# The files are memory-mapped, so a run starts from the cached ids without tokenizing anything. The key hashes
+# the tokenizer, the prompt template version and the rendered prompts.
+class TokenCache:
+
+    def __init__(self, cache_dir: str = DEFAULT_DIR):
+        self.cache_dir = cache_dir
+        # Hashes per tokenizer, dropped with it (an id could be reused by another tokenizer).
+        self.tokenizer_hashes = weakref.WeakKeyDictionary()
+
+    def key(self, tokenizer, dataset: str, level: str, prompts: list):
+        if tokenizer not in self.tokenizer_hashes:
+            self.tokenizer_hashes[tokenizer] = tokenizer_hash(tokenizer)
+
+        digest = hashlib.sha256(f"{self.tokenizer_hashes[tokenizer]}\0{PROMPT_VERSION}\0".encode())
+        for prompt in prompts:
+            digest.update(prompt.encode())
+            digest.update(b"\0")
+        return f"{dataset}-{level}-{digest.hexdigest()[:16]}"
+
+    def paths(self, key: str):
+        base = os.path.join(self.cache_dir, key)
+        return f"{base}.tokens", f"{base}.offsets"
+
+    # Tokenize the prompts in bulk and write their ids under a key.
+    # With the template and field values of the prompts, their ids are assembled at the token level.
+    def build(self, key: str, tokenizer, prompts: list, template=None, values: list = None):
+        tokens_path, offsets_path = self.paths(key)
+        if template is not None:
+            sequences = template.token_ids(tokenizer, values)
+        else:
+            sequences = tokenize_prompts(tokenizer, prompts)
+
+        offsets = np.zeros(len(sequences) + 1, dtype=np.int64)
+        np.cumsum([len(sequence) for sequence in sequences], out=offsets[1:])
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tokens = np.memmap(f"{tokens_path}.tmp", dtype=np.int32, mode='w+', shape=(max(int(offsets[-1]), 1),))
+        for sequence, start, end in zip(sequences, offsets[:-1], offsets[1:]):
+            tokens[start:end] = sequence
+        tokens.flush()
+        del tokens
+        offsets.tofile(f"{offsets_path}.tmp")
+
+        # The offsets are written last: they mark a complete entry.
+        os.replace(f"{tokens_path}.tmp", tokens_path)
+        os.replace(f"{offsets_path}.tmp", offsets_path)
+
+    # Memory-mapped token ids of a key, one array per prompt, or None if they are not cached.
+    def load(self, key: str):
+        tokens_path, offsets_path = self.paths(key)
+        if not os.path.exists(offsets_path):
+            return None
+
+        offsets = np.fromfile(offsets_path, dtype=np.int64)
+        # Copy-on-write mapping: the arrays are writable for torch, and the file is never modified.
+        tokens = np.memmap(tokens_path, dtype=np.int32, mode='c')
+        return [tokens[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+
+    # Token ids of the prompts of a dataset, tokenized and cached on the first use.
+    def sequences(self, tokenizer, dataset: str, level: str, prompts: list, template=None, values: list = None):
+        key = self.key(tokenizer, dataset, level, prompts)
+        sequences = self.load(key)
+        if sequences is None:
+            self.build(key, tokenizer, prompts, template, values)
+            sequences = self.load(key)
+        return sequences
@@ -0,0 +1,77 @@
+import os
+import warnings
+
+import torch
+
+
+# NUMA nodes of the machine, as exposed by Linux.
+NODE_DIR = "/sys/devices/system/node"
+
+
+# CPUs of a sysfs cpulist, e.g. "0-3,8-11".
+def parse_cpulist(text: str):
+    cpus = []
+    for part in text.strip().split(","):
+        if not part:
+            continue
+        first, _, last = part.partition("-")
+        cpus.extend(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+# CPUs this process may run on.
+def available_cpus():
+    return sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count()))
+
+
+# CPUs of every NUMA node with CPUs available to this process, {node: [cpus]}. Machines without NUMA information
+# (or another OS) are one node holding all the available CPUs.
+def numa_nodes(node_dir: str = NODE_DIR):
+    available = set(available_cpus())
+    nodes = {}
+    if os.path.isdir(node_dir):
+        for name in sorted(os.listdir(node_dir)):
+            cpulist_path = os.path.join(node_dir, name, "cpulist")
+            if not name.startswith("node") or not name[4:].isdigit() or not os.path.exists(cpulist_path):
+                continue
+            with open(cpulist_path, 'r') as cpulist:
+                cpus = [cpu for cpu in parse_cpulist(cpulist.read()) if cpu in available]
+            if cpus:
+                nodes[int(name[4:])] = cpus
+    return nodes or {0: sorted(available)}
+
+
+# Set the intra-op threads of torch and its inter-op threads, which can only be set before the first parallel work
+# of the process (a warning tells when they could not be). None keeps the current number.
+def configure_threads(threads: int = None, interop_threads: int = None):
+    if threads is not None:
+        torch.set_num_threads(threads)
+    if interop_threads is not None and interop_threads != torch.get_num_interop_threads():
+        try:
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError:
+            warnings.warn(f"torch inter-op threads are already running, keeping {torch.get_num_interop_threads()} "
+                          f"instead of {interop_threads}")
+
+
+# Pin the current process to CPUs and give torch one thread per CPU.
+def pin(cpus: list):
+    os.sched_setaffinity(0, cpus)
+    configure_threads(len(cpus), 1)
+
+
+# Copy the parameters and buffers of a model in place, so that a process pinned to a NUMA node reads a replica in
+# the memory of its node (pages are placed on the node of the first process touching them). Tied parameters are
+# one parameter and stay tied.
+def replicate(model):
+    with torch.no_grad():
+        for tensor in list(model.parameters()) + list(model.buffers()):
+            tensor.data = tensor.data.clone()
+
+
+# Drop the parameters and buffers of a model, leaving in their place a single element expanded to the same shape
+# and dtype: a process whose workers hold their own replicas keeps no copy of the weights.
+def release(model):
+    with torch.no_grad():
+        for tensor in list(model.parameters()) + list(model.buffers()):
+            tensor.data = torch.zeros((), dtype=tensor.dtype).expand(tensor.shape)
@@ -0,0 +1,134 @@
+from dialogue_eval.records import Example
+from dialogue_eval.templates import tokenize_prompts
+
+
+# Token caps of the prompts, applied on token ids by left truncation: max_turn_tokens keeps the last tokens of
+# every turn of the context, and max_prompt_tokens drops the oldest turns of the context until the whole prompt
+# fits. The response is never truncated, and the most recent turn of the context is never dropped. None disables
+# a cap.
+class TruncationPolicy:
+
+    def __init__(self, max_prompt_tokens: int = None, max_turn_tokens: int = None):
+        for name, cap in (("max_prompt_tokens", max_prompt_tokens), ("max_turn_tokens", max_turn_tokens)):
+            if cap is not None and cap <= 0:
+                raise ValueError(f"{name} must be positive, got {cap}")
+        self.max_prompt_tokens = max_prompt_tokens
+        self.max_turn_tokens = max_turn_tokens
+
+    def __bool__(self):
+        return self.max_prompt_tokens is not None or self.max_turn_tokens is not None
+
+    def __repr__(self):
+        return f"TruncationPolicy({self.max_prompt_tokens!r}, {self.max_turn_tokens!r})"
+
+    # Caps of the policy, as recorded in the journal keys and the run metadata.
+    def describe(self):
+        if not self:
+            return None
+        return {"max_prompt_tokens": self.max_prompt_tokens, "max_turn_tokens": self.max_turn_tokens}
+
+    # Suffix of the result files of truncated prompts, e.g. "-p2048-t256".
+    def suffix(self):
+        suffix = ""
+        if self.max_prompt_tokens is not None:
+            suffix += f"-p{self.max_prompt_tokens}"
+        if self.max_turn_tokens is not None:
+            suffix += f"-t{self.max_turn_tokens}"
+        return suffix
+
+
+# Example with another context: the turns at the removed positions are left out (the speakers are aligned with
+# the turns of the context, then the response).
+def _with_context(example: Example, context: tuple, removed: set = frozenset()):
+    speakers = example.speakers
+    if speakers is not None:
+        speakers = tuple(speaker for position, speaker in enumerate(speakers) if position not in removed)
+    context = tuple(turn for position, turn in enumerate(context) if position not in removed)
+    return Example(example.id_dialogue, context, example.response, example.score, dict(example.metadata), speakers)
+
+
+# Keep the last max_turn_tokens tokens of every turn of the contexts. Returns the new contexts and the number of
+# turns cut.
+def _cap_turns(tokenizer, contexts: list, max_turn_tokens: int):
+    texts = list(dict.fromkeys(turn for context in contexts for turn in context if turn is not None))
+    ids = dict(zip(texts, tokenize_prompts(tokenizer, texts)))
+
+    capped = {}
+    for text, turn_ids in ids.items():
+        if len(turn_ids) > max_turn_tokens:
+            # A cut through a multi-byte character decodes to a replacement character, which is left out.
+            capped[text] = tokenizer.decode(turn_ids[-max_turn_tokens:]).lstrip("\ufffd")
+
+    turns_cut = 0
+    new_contexts = []
+    for context in contexts:
+        turns_cut += sum(1 for turn in context if turn in capped)
+        new_contexts.append(tuple(capped.get(turn, turn) if turn is not None else None for turn in context))
+    return new_contexts, turns_cut
+
+
+# Truncate the examples of a dataset to the caps of a policy for a tokenizer. render(example) is the prompt of an
+# example. Returns the truncated examples and the truncation stats of the dataset.
+def truncate_examples(examples: list, tokenizer, policy: TruncationPolicy, render):
+    contexts = [example.context for example in examples]
+    turns_cut = 0
+    if policy.max_turn_tokens is not None:
+        contexts, turns_cut = _cap_turns(tokenizer, contexts, policy.max_turn_tokens)
+
+    truncated = [example if context == example.context else _with_context(example, context)
+                 for example, context in zip(examples, contexts)]
+    tokens_before = [len(ids) for ids in tokenize_prompts(tokenizer, [render(example) for example in examples])]
+    tokens_after = [len(ids) for ids in tokenize_prompts(tokenizer, [render(example) for example in truncated])]
+
+    # Fewest oldest turns dropped for each prompt over the cap to fit it, by a bisection run on all of them at once
+    # so that every step tokenizes one batch; all the droppable turns when the prompt never fits. The droppable
+    # turns are the turns before the most recent one that are not None (the None closing the FED dialogues stays
+    # where it is), oldest first.
+    def lengths(candidates: list):
+        return [len(ids) for ids in tokenize_prompts(tokenizer, [render(candidate) for candidate in candidates])]
+
+    over = [row for row, length in enumerate(tokens_after)
+            if policy.max_prompt_tokens is not None and length > policy.max_prompt_tokens]
+    droppable = {row: [position for position, turn in enumerate(truncated[row].context) if turn is not None][:-1]
+                 for row in over}
+    candidates = [_with_context(truncated[row], truncated[row].context, set(droppable[row])) for row in over]
+    over_budget = [row for row, length in zip(over, lengths(candidates)) if length > policy.max_prompt_tokens]
+    bounds = {row: [1, len(droppable[row])] for row in over}
+    for row in over_budget:
+        bounds[row][0] = bounds[row][1]
+
+    while True:
+        rows = [row for row in over if bounds[row][0] < bounds[row][1]]
+        if not rows:
+            break
+        middles = [(bounds[row][0] + bounds[row][1]) // 2 for row in rows]
+        candidates = [_with_context(truncated[row], truncated[row].context, set(droppable[row][:middle]))
+                      for row, middle in zip(rows, middles)]
+        for row, middle, length in zip(rows, middles, lengths(candidates)):
+            if length <= policy.max_prompt_tokens:
+                bounds[row][1] = middle
+            else:
+                bounds[row][0] = middle + 1
+
+    turns_dropped = 0
+    for row in over:
+        dropped = bounds[row][0]
+        truncated[row] = _with_context(truncated[row], truncated[row].context, set(droppable[row][:dropped]))
+        turns_dropped += dropped
+    for row, length in zip(over, lengths([truncated[row] for row in over])):
+        tokens_after[row] = length
+
+    changed = [before - after for before, after in zip(tokens_before, tokens_after) if after != before]
+    stats = {
+        "examples": len(examples),
+        "truncated_examples": len(changed),
+        "turns_cut": turns_cut,
+        "turns_dropped": turns_dropped,
+        "over_budget_examples": len(over_budget),
+        "tokens_before": sum(tokens_before),
+        "tokens_after": sum(tokens_after),
+        "tokens_removed_max": max(changed, default=0),
+        "max_tokens_before": max(tokens_before, default=0),
+        "max_tokens_after": max(tokens_after, default=0),
+    }
+    return truncated, stats